@@ -102,17 +102,84 @@ service:
 
 ragConfig:
   pdfUrl: ""
+  # Download, parse and index pdfUrl at startup; readiness waits for it at most pdfPreloadReadyTimeout seconds
+  pdfPreload: "true"
+  pdfPreloadReadyTimeout: 30
+  # Downloads above this size are rejected; cached URLs are revalidated after pdfRevalidateSeconds
+  pdfMaxMb: 100
+  pdfRevalidateSeconds: 60
+  # Cache bounds: downloaded PDFs (MB), entries per derived-data cache, batch results (hours)
+  pdfCacheMaxMb: 2048
+  cacheMaxEntries: 100000
+  batchTtlHours: 168
   embeddingEndpoint: "https://nv-embedqa-e5-v5.vincent-charbon-8e171347.serving.pcaidev.ai.greendatacenter.com/v1"
   embeddingToken: ""
   embeddingModel: "nvidia/nv-embedqa-e5-v5"
   llmEndpoint: "https://gpt-oss-120b.project-user-claudio-luethi.serving.pcaidev.ai.greendatacenter.com/v1"
   llmToken: ""
   llmModel: "openai/gpt-oss-120b"
+  # Optional comma-separated replicas; when set they replace the single endpoints above
+  embeddingEndpoints: ""
+  llmEndpoints: ""
+  # Routing across replicas: least_outstanding or latency
+  lbStrategy: "least_outstanding"
+  hedgeEnabled: "true"
+  # LLM hedges hold two upstream calls per admitted generation; off by default
+  llmHedgeEnabled: "false"
+  # "recursive" sizes chunks in characters; "token" in embedding-tokenizer tokens
+  splitter: "recursive"
   chunkSize: 512
   chunkOverlap: 64
+  # Token splitter: model input limit and tokenizer (tokenizer.json path or HF repo id; empty estimates)
+  embeddingMaxTokens: 512
+  tokenizer: ""
+  # Skip chunks whose estimated Jaccard similarity to a kept chunk is at least this; 0 disables
+  dedupThreshold: 0.85
   topK: 6
+  # Generation profile: fast, balanced or thorough (context budget, top_k; fast/thorough also send reasoning_effort, max_tokens)
+  generationProfile: "balanced"
+  # Profile used by requests without one while this many generations queue ("" disables)
+  loadShedProfile: ""
+  loadShedQueue: 4
+  # Chunk ranking: vector, bm25 (keyword), hybrid (rank fusion of both) or auto (bm25 when the prompt names a topic)
+  retrieval: "vector"
+  # Reuse the first retrieved context per document so repeat prompts hit the LLM prefix cache
+  pinContext: "false"
   chromaUrl: "http://chroma-db-service.chroma.svc.cluster.local:8000"
   chromaSslVerify: "true"
+  # "compact" keeps a quantized local index instead of Chroma (ignored when chromaUrl is set)
+  vectorStore: "chroma"
+  vectorQuantization: "int8"
+  vectorDim: 0
+  vectorReduction: "truncate"
+  # Loaded compact stores and BM25 indexes kept in memory per worker
+  indexCacheSlots: 8
+  # Worker processes per rag pod; empty derives the count from the CPU limit
+  workers: ""
+  # SQLite caches (embeddings, index registry) and ingest/download locks shared by
+  # the workers (and by all pods with rag.persistence); LLM slot locks stay pod-local
+  cacheDir: "/data/cache"
+  # Local vector indexes (Chroma persistent dirs or compact indexes)
+  chromaDir: "/data/chroma"
+  # End-to-end budget (seconds) for one generation; keep below the nginx/Istio timeouts
+  requestTimeout: 290
+  # LLM admission control: in-flight calls per rag pod and endpoint (shared by
+  # the pod's workers through pod-local lock files, never across pods); the
+  # wait queue and its timeout are per worker process
+  llmMaxInflight: 4
+  llmMaxQueue: 32
+  llmQueueTimeout: 60
+  # Background question banks filled with idle LLM capacity
+  pregenEnabled: "false"
+  pregenBankSize: 50
+  pregenBatch: 10
+  # Regenerate questions whose cosine similarity to another question in the quiz,
+  # or to one recently served for the same document, reaches this; 0 disables
+  questionDedupThreshold: 0.92
+  questionHistory: 200
+  # Enables the /debug endpoints (profiles, allocations, in-flight requests) when set;
+  # callers send it as X-Debug-Token. Stored in the Secret
+  debugToken: ""
 
 configMap:
   create: true
@@ -147,6 +214,20 @@ backend:
     storageClassName: ""
     mountPath: "/data"
 
+rag:
+  # Cache volume shared by every rag pod, mounted over ragConfig.cacheDir and
+  # ragConfig.chromaDir: vector indexes plus embedding, parsed-text and question
+  # caches, so new and restarted pods start warm. Use a ReadWriteMany storage
+  # class when replicaCount.rag > 1 or autoscaling.rag is enabled.
+  persistence:
+    enabled: false
+    existingClaim: ""
+    accessModes:
+      - ReadWriteMany
+    size: 20Gi
+    storageClassName: ""
+    mountPath: "/data"
+
 nodeSelector: {}
 tolerations: []
 affinity: {}
@@ -167,10 +248,11 @@ readinessProbe:
     failureThreshold: 3
     successThreshold: 1
   rag:
-    path: "/healthz"
-    initialDelaySeconds: 20
-    periodSeconds: 15
-    timeoutSeconds: 10
+    # /readyz reports 503 until heavy dependencies are warmed up and pdfUrl is preloaded (or pdfPreloadReadyTimeout passed)
+    path: "/readyz"
+    initialDelaySeconds: 2
+    periodSeconds: 3
+    timeoutSeconds: 5
     failureThreshold: 3
     successThreshold: 1
 
@@ -191,7 +273,7 @@ livenessProbe:
     successThreshold: 1
   rag:
     path: "/healthz"
-    initialDelaySeconds: 60
+    initialDelaySeconds: 10
     periodSeconds: 30
     timeoutSeconds: 10
     failureThreshold: 3
@@ -203,6 +285,30 @@ hpa:
   maxReplicas: 3
   targetCPUUtilizationPercentage: 60
 
+autoscaling:
+  rag:
+    # Scale rag pods on LLM admission metrics from /metrics instead of CPU.
+    enabled: false
+    # "hpa" needs a custom metrics adapter (e.g. prometheus-adapter) serving the
+    # rag_* pod metrics; "keda" queries Prometheus directly through a ScaledObject
+    mode: "hpa"
+    minReplicas: 1
+    maxReplicas: 4
+    # Per-pod targets: generations holding an LLM slot, generations waiting for one,
+    # and the average queue wait in seconds. A pod holds at most
+    # ragConfig.llmMaxInflight x LLM endpoints slots, so targetInflight must stay
+    # below that product (default 4 x 1) or the in-flight trigger never fires.
+    targetInflight: 3
+    targetQueueDepth: 2
+    targetQueueWaitSeconds: 5
+    scaleDownStabilizationSeconds: 300
+    # Adds prometheus.io/* scrape annotations to the rag pods
+    scrapeAnnotations: true
+    keda:
+      prometheusAddress: "http://prometheus-server.monitoring.svc.cluster.local:80"
+      pollingInterval: 15
+      cooldownPeriod: 300
+
 ingress:
   enabled: false
   host: ai-quiz.example.com
@@ -214,6 +320,12 @@ ezua:
     domain: "${DOMAIN_NAME}"
     istioGateway: "istio-system/ezaf-gateway"
     timeout: "300s"
+
+ragRouting:
+  # Istio DestinationRule hashing the X-Document-Key header (a document content hash
+  # the backend sends with every request) so all requests for a document reach the same rag pod
+  documentAffinity: true
+  minimumRingSize: 1024
 """
 with open(os.path.join(base_dir, "values.yaml"), "w") as f:
     f.write(values_yaml)
@@ -396,7 +508,9 @@ metadata:
     {{- include "ai-quiz-generator.labels" . | nindent 4 }}
     app.kubernetes.io/component: rag
 spec:
+  {{- if not .Values.autoscaling.rag.enabled }}
   replicas: {{ .Values.replicaCount.rag }}
+  {{- end }}
   selector:
     matchLabels:
       app: {{ include "ai-quiz-generator.name" . }}
@@ -406,6 +520,12 @@ spec:
       labels:
         app: {{ include "ai-quiz-generator.name" . }}
         app.kubernetes.io/component: rag
+      {{- if and .Values.autoscaling.rag.enabled .Values.autoscaling.rag.scrapeAnnotations }}
+      annotations:
+        prometheus.io/scrape: "true"
+        prometheus.io/port: {{ .Values.service.rag.port | quote }}
+        prometheus.io/path: "/metrics"
+      {{- end }}
     spec:
       {{- with .Values.nodeSelector }}
       nodeSelector:
@@ -450,6 +570,17 @@ spec:
             successThreshold: {{ .Values.livenessProbe.rag.successThreshold }}
           resources:
             {{- toYaml .Values.resources.rag | nindent 12 }}
+          {{- if .Values.rag.persistence.enabled }}
+          volumeMounts:
+            - name: rag-cache
+              mountPath: {{ .Values.rag.persistence.mountPath | quote }}
+          {{- end }}
+      {{- if .Values.rag.persistence.enabled }}
+      volumes:
+        - name: rag-cache
+          persistentVolumeClaim:
+            claimName: {{ .Values.rag.persistence.existingClaim | default (printf "%s-rag-cache" (include "ai-quiz-generator.fullname" .)) }}
+      {{- end }}
 """
 with open(os.path.join(templates_dir, "rag-deployment.yaml"), "w") as f:
     f.write(rag_deployment_yaml)
@@ -546,15 +677,54 @@ metadata:
     {{- include "ai-quiz-generator.labels" . | nindent 4 }}
 data:
   RAG_PDF_URL: {{ .Values.ragConfig.pdfUrl | quote }}
+  RAG_PDF_PRELOAD: {{ .Values.ragConfig.pdfPreload | quote }}
+  RAG_PDF_PRELOAD_READY_TIMEOUT: {{ .Values.ragConfig.pdfPreloadReadyTimeout | quote }}
+  RAG_PDF_MAX_MB: {{ .Values.ragConfig.pdfMaxMb | quote }}
+  RAG_PDF_REVALIDATE_SECONDS: {{ .Values.ragConfig.pdfRevalidateSeconds | quote }}
+  RAG_PDF_CACHE_MAX_MB: {{ .Values.ragConfig.pdfCacheMaxMb | quote }}
+  RAG_CACHE_MAX_ENTRIES: {{ .Values.ragConfig.cacheMaxEntries | quote }}
+  RAG_BATCH_TTL_HOURS: {{ .Values.ragConfig.batchTtlHours | quote }}
   RAG_EMBEDDING_ENDPOINT: {{ .Values.ragConfig.embeddingEndpoint | quote }}
   RAG_EMBEDDING_MODEL: {{ .Values.ragConfig.embeddingModel | quote }}
   RAG_LLM_ENDPOINT: {{ .Values.ragConfig.llmEndpoint | quote }}
   RAG_LLM_MODEL: {{ .Values.ragConfig.llmModel | quote }}
+  RAG_EMBEDDING_ENDPOINTS: {{ .Values.ragConfig.embeddingEndpoints | quote }}
+  RAG_LLM_ENDPOINTS: {{ .Values.ragConfig.llmEndpoints | quote }}
+  RAG_LB_STRATEGY: {{ .Values.ragConfig.lbStrategy | quote }}
+  RAG_HEDGE_ENABLED: {{ .Values.ragConfig.hedgeEnabled | quote }}
+  RAG_LLM_HEDGE_ENABLED: {{ .Values.ragConfig.llmHedgeEnabled | quote }}
+  RAG_SPLITTER: {{ .Values.ragConfig.splitter | quote }}
   RAG_CHUNK_SIZE: {{ .Values.ragConfig.chunkSize | quote }}
   RAG_CHUNK_OVERLAP: {{ .Values.ragConfig.chunkOverlap | quote }}
+  RAG_EMBEDDING_MAX_TOKENS: {{ .Values.ragConfig.embeddingMaxTokens | quote }}
+  RAG_TOKENIZER: {{ .Values.ragConfig.tokenizer | quote }}
+  RAG_DEDUP_THRESHOLD: {{ .Values.ragConfig.dedupThreshold | quote }}
   RAG_TOP_K: {{ .Values.ragConfig.topK | quote }}
+  RAG_GENERATION_PROFILE: {{ .Values.ragConfig.generationProfile | quote }}
+  RAG_LOAD_SHED_PROFILE: {{ .Values.ragConfig.loadShedProfile | quote }}
+  RAG_LOAD_SHED_QUEUE: {{ .Values.ragConfig.loadShedQueue | quote }}
+  RAG_RETRIEVAL: {{ .Values.ragConfig.retrieval | quote }}
+  RAG_PIN_CONTEXT: {{ .Values.ragConfig.pinContext | quote }}
   RAG_CHROMA_URL: {{ .Values.ragConfig.chromaUrl | quote }}
   RAG_CHROMA_SSL_VERIFY: {{ .Values.ragConfig.chromaSslVerify | quote }}
+  RAG_VECTOR_STORE: {{ .Values.ragConfig.vectorStore | quote }}
+  RAG_VECTOR_QUANTIZATION: {{ .Values.ragConfig.vectorQuantization | quote }}
+  RAG_VECTOR_DIM: {{ .Values.ragConfig.vectorDim | quote }}
+  RAG_VECTOR_REDUCTION: {{ .Values.ragConfig.vectorReduction | quote }}
+  RAG_INDEX_CACHE_SLOTS: {{ .Values.ragConfig.indexCacheSlots | quote }}
+  RAG_WORKERS: {{ .Values.ragConfig.workers | quote }}
+  RAG_CACHE_DIR: {{ .Values.ragConfig.cacheDir | quote }}
+  RAG_CHROMA_DIR: {{ .Values.ragConfig.chromaDir | quote }}
+  RAG_CACHE_JOURNAL_MODE: {{ ternary "delete" "wal" .Values.rag.persistence.enabled | quote }}
+  RAG_REQUEST_TIMEOUT: {{ .Values.ragConfig.requestTimeout | quote }}
+  RAG_LLM_MAX_INFLIGHT: {{ .Values.ragConfig.llmMaxInflight | quote }}
+  RAG_LLM_MAX_QUEUE: {{ .Values.ragConfig.llmMaxQueue | quote }}
+  RAG_LLM_QUEUE_TIMEOUT: {{ .Values.ragConfig.llmQueueTimeout | quote }}
+  RAG_PREGEN_ENABLED: {{ .Values.ragConfig.pregenEnabled | quote }}
+  RAG_PREGEN_BANK_SIZE: {{ .Values.ragConfig.pregenBankSize | quote }}
+  RAG_PREGEN_BATCH: {{ .Values.ragConfig.pregenBatch | quote }}
+  RAG_QUESTION_DEDUP_THRESHOLD: {{ .Values.ragConfig.questionDedupThreshold | quote }}
+  RAG_QUESTION_HISTORY: {{ .Values.ragConfig.questionHistory | quote }}
 {{- end }}
 """
 with open(os.path.join(templates_dir, "configmap.yaml"), "w") as f:
@@ -573,6 +743,7 @@ type: Opaque
 stringData:
   RAG_EMBEDDING_TOKEN: {{ .Values.ragConfig.embeddingToken | quote }}
   RAG_LLM_TOKEN: {{ .Values.ragConfig.llmToken | quote }}
+  RAG_DEBUG_TOKEN: {{ .Values.ragConfig.debugToken | quote }}
 {{- end }}
 """
 with open(os.path.join(templates_dir, "secret.yaml"), "w") as f:
@@ -628,6 +799,35 @@ spec:
 with open(os.path.join(templates_dir, "backend-pvc.yaml"), "w") as f:
     f.write(backend_pvc_yaml)
 
+# ---------------------------
+# RAG cache PVC (optional, shared by all rag pods)
+# ---------------------------
+print("Writing rag-pvc.yaml...")
+rag_pvc_yaml = """\
+{{- if and .Values.rag.persistence.enabled (not .Values.rag.persistence.existingClaim) }}
+apiVersion: v1
+kind: PersistentVolumeClaim
+metadata:
+  name: {{ include "ai-quiz-generator.fullname" . }}-rag-cache
+  labels:
+    {{- include "ai-quiz-generator.labels" . | nindent 4 }}
+    app.kubernetes.io/component: rag
+spec:
+  accessModes:
+{{- range .Values.rag.persistence.accessModes }}
+    - {{ . | quote }}
+{{- end }}
+  resources:
+    requests:
+      storage: {{ .Values.rag.persistence.size | quote }}
+  {{- if .Values.rag.persistence.storageClassName }}
+  storageClassName: {{ .Values.rag.persistence.storageClassName | quote }}
+  {{- end }}
+{{- end }}
+"""
+with open(os.path.join(templates_dir, "rag-pvc.yaml"), "w") as f:
+    f.write(rag_pvc_yaml)
+
 # ---------------------------
 # HorizontalPodAutoscaler (optional)
 # ---------------------------
@@ -657,6 +857,102 @@ spec:
 with open(os.path.join(templates_dir, "hpa.yaml"), "w") as f:
     f.write(hpa_yaml)
 
+# ---------------------------
+# RAG autoscaler on LLM admission metrics (optional): HPA or KEDA
+# ---------------------------
+print("Writing rag-autoscaler.yaml...")
+rag_autoscaler_yaml = """\
+{{- if .Values.autoscaling.rag.enabled }}
+{{- $fullname := include "ai-quiz-generator.fullname" . }}
+{{- with .Values.autoscaling.rag }}
+{{- if eq .mode "keda" }}
+{{- $selector := printf "namespace=\\"%s\\", pod=~\\"%s-rag-.*\\"" $.Release.Namespace $fullname }}
+apiVersion: keda.sh/v1alpha1
+kind: ScaledObject
+metadata:
+  name: {{ $fullname }}-rag
+  labels:
+    {{- include "ai-quiz-generator.labels" $ | nindent 4 }}
+    app.kubernetes.io/component: rag
+spec:
+  scaleTargetRef:
+    name: {{ $fullname }}-rag
+  minReplicaCount: {{ .minReplicas }}
+  maxReplicaCount: {{ .maxReplicas }}
+  pollingInterval: {{ .keda.pollingInterval }}
+  cooldownPeriod: {{ .keda.cooldownPeriod }}
+  advanced:
+    horizontalPodAutoscalerConfig:
+      behavior:
+        scaleDown:
+          stabilizationWindowSeconds: {{ .scaleDownStabilizationSeconds }}
+  triggers:
+    - type: prometheus
+      metricType: AverageValue
+      metadata:
+        serverAddress: {{ .keda.prometheusAddress | quote }}
+        query: sum(rag_llm_inflight{ {{- $selector -}} })
+        threshold: {{ .targetInflight | quote }}
+    - type: prometheus
+      metricType: AverageValue
+      metadata:
+        serverAddress: {{ .keda.prometheusAddress | quote }}
+        query: sum(rag_llm_queue_depth{ {{- $selector -}} })
+        threshold: {{ .targetQueueDepth | quote }}
+    - type: prometheus
+      metricType: Value
+      metadata:
+        serverAddress: {{ .keda.prometheusAddress | quote }}
+        query: sum(rate(rag_llm_queue_wait_seconds_sum{ {{- $selector -}} }[2m])) / clamp_min(sum(rate(rag_llm_queue_wait_seconds_count{ {{- $selector -}} }[2m])), 1e-9)
+        threshold: {{ .targetQueueWaitSeconds | quote }}
+{{- else }}
+apiVersion: autoscaling/v2
+kind: HorizontalPodAutoscaler
+metadata:
+  name: {{ $fullname }}-rag
+  labels:
+    {{- include "ai-quiz-generator.labels" $ | nindent 4 }}
+    app.kubernetes.io/component: rag
+spec:
+  scaleTargetRef:
+    apiVersion: apps/v1
+    kind: Deployment
+    name: {{ $fullname }}-rag
+  minReplicas: {{ .minReplicas }}
+  maxReplicas: {{ .maxReplicas }}
+  behavior:
+    scaleDown:
+      stabilizationWindowSeconds: {{ .scaleDownStabilizationSeconds }}
+  metrics:
+    - type: Pods
+      pods:
+        metric:
+          name: rag_llm_inflight
+        target:
+          type: AverageValue
+          averageValue: {{ .targetInflight | quote }}
+    - type: Pods
+      pods:
+        metric:
+          name: rag_llm_queue_depth
+        target:
+          type: AverageValue
+          averageValue: {{ .targetQueueDepth | quote }}
+    - type: Pods
+      pods:
+        # Derived by the metrics adapter from the rag_llm_queue_wait_seconds summary
+        metric:
+          name: rag_llm_queue_wait_seconds_avg
+        target:
+          type: AverageValue
+          averageValue: {{ .targetQueueWaitSeconds | quote }}
+{{- end }}
+{{- end }}
+{{- end }}
+"""
+with open(os.path.join(templates_dir, "rag-autoscaler.yaml"), "w") as f:
+    f.write(rag_autoscaler_yaml)
+
 # ---------------------------
 # VirtualService (Istio) for Frontend
 # ---------------------------
@@ -691,6 +987,32 @@ spec:
 with open(os.path.join(templates_dir, "virtualservice.yaml"), "w") as f:
     f.write(virtualservice_yaml)
 
+# ---------------------------
+# DestinationRule (Istio) for RAG document affinity
+# ---------------------------
+print("Writing rag-destinationrule.yaml...")
+rag_destinationrule_yaml = """\
+{{- if .Values.ragRouting.documentAffinity }}
+apiVersion: networking.istio.io/v1alpha3
+kind: DestinationRule
+metadata:
+  name: {{ include "ai-quiz-generator.fullname" . }}-rag
+  namespace: {{ .Release.Namespace }}
+  labels:
+    {{- include "ai-quiz-generator.labels" . | nindent 4 }}
+    app.kubernetes.io/component: rag
+spec:
+  host: {{ .Values.service.rag.name }}.{{ .Release.Namespace }}.svc.cluster.local
+  trafficPolicy:
+    loadBalancer:
+      consistentHash:
+        httpHeaderName: x-document-key
+        minimumRingSize: {{ .Values.ragRouting.minimumRingSize }}
+{{- end }}
+"""
+with open(os.path.join(templates_dir, "rag-destinationrule.yaml"), "w") as f:
+    f.write(rag_destinationrule_yaml)
+
 # ---------------------------
 # NOTES.txt
 # ---------------------------
@@ -720,6 +1042,9 @@ CONFIG:
 - By default, a ConfigMap and Secret are created from values.yaml and mounted as env vars in backend and rag.
 - For existing resources, set configMap.name / secret.name and set create=false.
 - The backend can persist the last-used config to a PVC. See backend.persistence in values.yaml.
+- rag pods can share one cache volume (vectors, embeddings, parsed text). See rag.persistence in values.yaml.
+- rag pods can autoscale on LLM queue metrics (HPA via a metrics adapter, or KEDA). See autoscaling.rag.
+- With Istio, requests for the same document stick to one rag pod (X-Document-Key). See ragRouting.
 
 Install the chart:
   helm install ai-quiz-generator ./ai-quiz-generator
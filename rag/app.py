@@ -1,23 +1,103 @@
+import asyncio
 import base64
+import concurrent.futures
+import contextvars
+import fcntl
 import hashlib
+import heapq
+import hmac
+import importlib
+import itertools
 import json
+import logging
+import math
 import os
+import random
 import re
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import OrderedDict, deque
+from contextlib import ExitStack, asynccontextmanager, contextmanager
 from urllib.parse import urlparse
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterator, Optional
 
+import httpx
+import numpy as np
 import requests
-import chromadb
-from chromadb.config import Settings
-from fastapi import FastAPI, HTTPException
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.embeddings import Embeddings
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+# Heavy dependencies (chromadb, langchain) are imported lazily so the server
+# can start listening immediately; a background warm-up thread pulls them in.
+HEAVY_MODULES = (
+    "chromadb",
+    "chromadb.config",
+    "langchain_community.document_loaders",
+    "langchain_community.vectorstores",
+    "langchain_core.documents",
+    "langchain_text_splitters",
+)
+IMPORT_TIMINGS: dict[str, float] = {}
+_WARM_STATE: dict[str, Any] = {"ready": False, "error": "", "seconds": None}
+
+
+def _import(name: str):
+    # import_module (not a bare sys.modules lookup) so a caller racing the
+    # warm-up thread waits on the import lock instead of getting a
+    # partially initialized module.
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        IMPORT_TIMINGS.setdefault(name, round(time.perf_counter() - start, 4))
+    return module
+
+
+def _warm_up() -> None:
+    start = time.perf_counter()
+    try:
+        for name in HEAVY_MODULES:
+            _import(name)
+    except Exception as e:
+        _WARM_STATE["error"] = f"{type(e).__name__}: {e}"
+        return
+    _WARM_STATE["seconds"] = round(time.perf_counter() - start, 4)
+    _WARM_STATE["ready"] = True
 
-app = FastAPI()
+
+logger = logging.getLogger("rag")
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global _PREGEN_QUEUE, _PRELOAD_READY_AT
+    threading.Thread(target=_warm_up, name="rag-warm-up", daemon=True).start()
+    if not _PRELOAD_STATE["done"]:
+        _PRELOAD_READY_AT = time.monotonic() + PDF_PRELOAD_READY_TIMEOUT
+        threading.Thread(target=_preload_default_document, name="rag-preload", daemon=True).start()
+    pregen_task = None
+    if PREGEN_ENABLED:
+        _PREGEN_QUEUE = asyncio.Queue()
+        pregen_task = asyncio.create_task(_pregen_worker())
+    metrics_task = asyncio.create_task(_metrics_publisher())
+    if DEBUG_TOKEN:
+        threading.Thread(target=_rss_sampler, name="rag-rss-sampler", daemon=True).start()
+    yield
+    metrics_task.cancel()
+    if pregen_task is not None:
+        pregen_task.cancel()
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 DEFAULT_SYSTEM_PROMPT = (
     "You are a quiz generator. You must return ONLY valid JSON. "
@@ -41,7 +121,7 @@ Each element MUST have exactly this structure:
 }}
 
 Rules:
-- Generate exactly {n} questions.
+- Generate exactly the number of questions requested at the end.
 - Each question must have exactly 4 options.
 - correctIndex must be 0, 1, 2, or 3.
 - Questions MUST come from the provided context.
@@ -54,65 +134,745 @@ Context:
 ----------------
 """
 
+# Per-request variables go last so the instructions and context above form a
+# byte-identical prefix for the same document (server-side KV prefix caching).
+REQUEST_SUFFIX = """
+Generate exactly {n} questions.
+"""
+
+
+def _build_prompt(context: str, n: int) -> str:
+    return STRICT_JSON_PROMPT.format(context=context) + REQUEST_SUFFIX.format(n=n)
+
+
+CACHE_DIR = Path(os.getenv("RAG_CACHE_DIR", "/data/cache"))
+# WAL needs shared memory between the processes using a database, so a cache
+# directory on a volume shared by pods on different nodes (ReadWriteMany/NFS)
+# must use the rollback journal ("delete") instead.
+CACHE_JOURNAL_MODE = os.getenv("RAG_CACHE_JOURNAL_MODE", "wal").lower()
+# Entry cap of each derived-data cache (embeddings, parsed pages, page chunks,
+# page owners, download validators); least recently used entries go first.
+CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "100000"))
+
+
+class SharedCache:
+    """SQLite-backed key/value store shared by all worker processes of a pod.
+
+    With max_entries and/or ttl set, entries carry a last-use time (refreshed
+    at most once a minute on reads) and every few hundred writes the table
+    drops entries unused for ttl seconds and the least recently used ones
+    beyond max_entries.
+    """
+
+    TOUCH_SECONDS = 60
+    EVICT_EVERY = 256
+
+    def __init__(self, path: Path, table: str, max_entries: int = 0, ttl: float = 0):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        self._local = threading.local()
+
+    @property
+    def bounded(self) -> bool:
+        return self.max_entries > 0 or self.ttl > 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute(f"PRAGMA journal_mode={CACHE_JOURNAL_MODE}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value BLOB, used REAL DEFAULT 0)"
+            )
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({self.table})")}
+            if "used" not in columns:
+                # Tables created before eviction existed; their rows go first.
+                conn.execute(f"ALTER TABLE {self.table} ADD COLUMN used REAL DEFAULT 0")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_used ON {self.table} (used)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._conn().execute(f"SELECT value, used FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if self.bounded and now - row[1] > self.TOUCH_SECONDS:
+            self._conn().execute(f"UPDATE {self.table} SET used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        self._conn().execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, used) VALUES (?, ?, ?)",
+            (key, sqlite3.Binary(value), time.time()),
+        )
+        if self.bounded:
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 1:
+                self.evict()
+
+    def evict(self) -> int:
+        """Apply ttl and max_entries now; returns the number of entries removed."""
+        conn = self._conn()
+        removed = 0
+        if self.ttl > 0:
+            removed += conn.execute(f"DELETE FROM {self.table} WHERE used < ?", (time.time() - self.ttl,)).rowcount
+        if self.max_entries > 0:
+            (count,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+            if count > self.max_entries:
+                removed += conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,),
+                ).rowcount
+        return removed
+
+    def get_json(self, key: str) -> Optional[Any]:
+        raw = self.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set_json(self, key: str, value: Any) -> None:
+        self.set(key, json.dumps(value).encode("utf-8"))
+
+
+EMBEDDING_CACHE = SharedCache(CACHE_DIR / "embeddings.sqlite", "embeddings", max_entries=CACHE_MAX_ENTRIES)
+INDEX_REGISTRY = SharedCache(CACHE_DIR / "registry.sqlite", "indexes")
+PINNED_CONTEXTS = SharedCache(CACHE_DIR / "registry.sqlite", "pinned_contexts")
+PARSED_PAGES = SharedCache(CACHE_DIR / "parsed.sqlite", "pages", max_entries=CACHE_MAX_ENTRIES)
+PAGE_CHUNKS = SharedCache(CACHE_DIR / "parsed.sqlite", "page_chunks", max_entries=CACHE_MAX_ENTRIES)
+PAGE_OWNERS = SharedCache(CACHE_DIR / "parsed.sqlite", "page_owners", max_entries=CACHE_MAX_ENTRIES)
+
+
+LOCK_POLL_SECONDS = 0.1
+
+
+@contextmanager
+def _process_lock(name: str, blocking: bool = True):
+    """Exclusive lock shared across worker processes (and threads) via flock.
+    Non-blocking callers get False when another holder has it. Inside a
+    request, a blocking wait polls instead and raises DeadlineExceeded once
+    the request's deadline passes or its client goes away."""
+    lock_dir = CACHE_DIR / "locks"
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with open(lock_dir / f"{name}.lock", "a+") as fh:
+        deadline = _DEADLINE.get() if blocking else None
+        try:
+            if deadline is None:
+                fcntl.flock(fh, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                while True:
+                    try:
+                        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        time.sleep(min(LOCK_POLL_SECONDS, deadline.check(f"{name.split('-')[0]} lock wait")))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+REQUEST_TIMEOUT = float(os.getenv("RAG_REQUEST_TIMEOUT", "290"))
+
+
+class DeadlineExceeded(HTTPException):
+    """Raised when a request's time budget is used up or its client went away."""
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+        self.cancelled = False
+        # Last pipeline stage that checked the budget (shown by /debug/requests).
+        self.stage = ""
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def check(self, stage: str) -> float:
+        self.stage = stage
+        if self.cancelled:
+            raise DeadlineExceeded(status_code=499, detail=f"Client disconnected during {stage}")
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(status_code=504, detail=f"Request deadline exceeded during {stage}")
+        return remaining
+
+
+_DEADLINE: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("rag_deadline", default=None)
+
+
+def _stage_timeout(stage: str, cap: float) -> float:
+    """Per-call timeout for a pipeline stage: the remaining request budget, at most `cap`."""
+    deadline = _DEADLINE.get()
+    if deadline is None:
+        return cap
+    return min(cap, deadline.check(stage))
+
+
+def _check_deadline(stage: str) -> None:
+    deadline = _DEADLINE.get()
+    if deadline is not None:
+        deadline.check(stage)
+
+
+def _request_deadline(request: Request, rag: Dict[str, Any]) -> Deadline:
+    """Budget from the X-Request-Timeout header (seconds), else rag.timeout_seconds, else RAG_REQUEST_TIMEOUT."""
+    seconds = request.headers.get("x-request-timeout") or rag.get("timeout_seconds") or REQUEST_TIMEOUT
+    try:
+        seconds = float(seconds)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid request timeout")
+    return Deadline(min(seconds, REQUEST_TIMEOUT))
+
+
+async def _in_thread(func, *args):
+    """run_in_threadpool that carries the request deadline into the worker thread."""
+    return await run_in_threadpool(contextvars.copy_context().run, func, *args)
+
+
+async def _with_deadline(request: Request, deadline: Deadline, coro):
+    """Run `coro` under `deadline`; cancel it when the budget runs out or the client disconnects."""
+    record = _REQUEST_RECORD.get()
+    if record is not None:
+        record["deadline"] = deadline
+    token = _DEADLINE.set(deadline)
+    try:
+        task = asyncio.ensure_future(coro)
+    finally:
+        _DEADLINE.reset(token)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=min(1.0, max(deadline.remaining(), 0.01)))
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                deadline.cancelled = True
+            # Report (and keep) the stage the work is actually in.
+            deadline.check(deadline.stage or "generation")
+    finally:
+        task.cancel()
+
+
+class UpstreamRejected(HTTPException):
+    """A 4xx from an upstream service: the request itself is at fault, so it is
+    neither retried on another replica nor counted against the endpoint's health."""
 
-class NIMEmbedding(Embeddings):
-    def __init__(self, endpoint: str, token: str, model: str, max_chars: int = 2000):
-        self.endpoint = endpoint.rstrip("/")
+
+# Client-side statuses that still say something about the replica (timeout, overload).
+_RETRYABLE_4XX = {408, 429}
+
+
+def _upstream_error(service: str, status_code: int, text: str) -> HTTPException:
+    if 400 <= status_code < 500 and status_code not in _RETRYABLE_4XX:
+        return UpstreamRejected(status_code=502, detail=f"{service} rejected the request ({status_code}): {text}")
+    return HTTPException(status_code=500, detail=f"{service} error {status_code}: {text}")
+
+
+LB_STRATEGY = os.getenv("RAG_LB_STRATEGY", "least_outstanding")  # or "latency"
+HEDGE_ENABLED = os.getenv("RAG_HEDGE_ENABLED", "true").lower() != "false"
+# A hedged generation holds two upstream calls under one admission slot, just
+# when the LLM is slow; off unless explicitly enabled.
+LLM_HEDGE_ENABLED = os.getenv("RAG_LLM_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_MIN_DELAY = float(os.getenv("RAG_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = 20
+CIRCUIT_FAILURES = int(os.getenv("RAG_CIRCUIT_FAILURES", "3"))
+CIRCUIT_COOLDOWN = float(os.getenv("RAG_CIRCUIT_COOLDOWN", "30"))
+
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+_HEDGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="rag-hedge")
+
+
+def _http_client() -> httpx.AsyncClient:
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        _HTTP_CLIENT = httpx.AsyncClient(verify=False, timeout=120)
+    return _HTTP_CLIENT
+
+
+class _EndpointState:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.latencies: deque[float] = deque(maxlen=200)
+        self.latency_ewma: Optional[float] = None
+        self.failures = 0
+        self.open_until = 0.0
+
+
+class EndpointPool:
+    """Replicas of one OpenAI-compatible service: least-outstanding or
+    latency-weighted routing, p95-based hedging and per-endpoint circuit
+    breakers. Shared by the event loop and threadpool threads."""
+
+    def __init__(self, urls: list[str], hedge: bool = True):
+        self.endpoints = [_EndpointState(u) for u in urls]
+        self.hedge = hedge
+        self._lock = threading.Lock()
+
+    def _score(self, ep: _EndpointState) -> float:
+        if LB_STRATEGY == "latency":
+            return (ep.latency_ewma or 0.0) * (ep.outstanding + 1)
+        return ep.outstanding + (ep.latency_ewma or 0.0) * 1e-6
+
+    def pick(self, exclude: set[str]) -> Optional[_EndpointState]:
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep.url not in exclude]
+            if not candidates:
+                return None
+            now = time.monotonic()
+            closed = [ep for ep in candidates if ep.open_until <= now]
+            # With every breaker open, probe the one that will recover first.
+            ep = min(closed, key=self._score) if closed else min(candidates, key=lambda e: e.open_until)
+            ep.outstanding += 1
+            return ep
+
+    def finish(self, ep: _EndpointState, ok: Optional[bool], seconds: float) -> None:
+        """Record an attempt; ok=None means it was cancelled and says nothing about health."""
+        with self._lock:
+            ep.outstanding -= 1
+            if ok is None:
+                return
+            if ok:
+                ep.failures = 0
+                ep.open_until = 0.0
+                ep.latencies.append(seconds)
+                ep.latency_ewma = seconds if ep.latency_ewma is None else 0.8 * ep.latency_ewma + 0.2 * seconds
+            else:
+                ep.failures += 1
+                if ep.failures >= CIRCUIT_FAILURES:
+                    ep.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            samples = sorted(s for ep in self.endpoints for s in ep.latencies)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, samples[int(0.95 * (len(samples) - 1))])
+
+    async def acall(self, attempt):
+        """Run `await attempt(url)` with failover and hedging; the losing call is cancelled."""
+        tried: set[str] = set()
+        tasks: dict[asyncio.Task, _EndpointState] = {}
+        last_error: Optional[BaseException] = None
+        delay = self.hedge_delay()
+
+        async def timed(ep: _EndpointState):
+            start = time.monotonic()
+            try:
+                result = await attempt(ep.url)
+            except (asyncio.CancelledError, DeadlineExceeded, UpstreamRejected):
+                self.finish(ep, None, 0.0)
+                raise
+            except Exception:
+                self.finish(ep, False, time.monotonic() - start)
+                raise
+            self.finish(ep, True, time.monotonic() - start)
+            return result
+
+        def launch() -> bool:
+            ep = self.pick(tried)
+            if ep is None:
+                return False
+            tried.add(ep.url)
+            tasks[asyncio.create_task(timed(ep))] = ep
+            return True
+
+        launch()
+        hedged = False
+        try:
+            while tasks:
+                wait_for = delay if not hedged and len(tried) < len(self.endpoints) else None
+                done, _ = await asyncio.wait(tasks, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    launch()
+                    continue
+                for task in done:
+                    del tasks[task]
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    if isinstance(last_error, (DeadlineExceeded, UpstreamRejected)):
+                        raise last_error
+                if not tasks:
+                    launch()
+            raise last_error or RuntimeError("No endpoint available")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def call(self, attempt):
+        """Blocking variant of acall for threadpool callers. A losing hedge
+        cannot be interrupted mid-request, so it is abandoned instead."""
+        if len(self.endpoints) == 1:
+            ep = self.pick(set())
+            start = time.monotonic()
+            try:
+                result = attempt(ep.url)
+            except (DeadlineExceeded, UpstreamRejected):
+                self.finish(ep, None, 0.0)
+                raise
+            except Exception:
+                self.finish(ep, False, time.monotonic() - start)
+                raise
+            self.finish(ep, True, time.monotonic() - start)
+            return result
+
+        tried: set[str] = set()
+        futures: dict[concurrent.futures.Future, _EndpointState] = {}
+        last_error: Optional[BaseException] = None
+        delay = self.hedge_delay()
+
+        def timed(ep: _EndpointState):
+            start = time.monotonic()
+            try:
+                result = attempt(ep.url)
+            except (DeadlineExceeded, UpstreamRejected):
+                self.finish(ep, None, 0.0)
+                raise
+            except Exception:
+                self.finish(ep, False, time.monotonic() - start)
+                raise
+            self.finish(ep, True, time.monotonic() - start)
+            return result
+
+        def launch() -> bool:
+            ep = self.pick(tried)
+            if ep is None:
+                return False
+            tried.add(ep.url)
+            futures[_HEDGE_EXECUTOR.submit(contextvars.copy_context().run, timed, ep)] = ep
+            return True
+
+        launch()
+        hedged = False
+        try:
+            while futures:
+                wait_for = delay if not hedged and len(tried) < len(self.endpoints) else None
+                done, _ = concurrent.futures.wait(
+                    futures, timeout=wait_for, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    launch()
+                    continue
+                for future in done:
+                    del futures[future]
+                    if future.exception() is None:
+                        return future.result()
+                    last_error = future.exception()
+                    if isinstance(last_error, (DeadlineExceeded, UpstreamRejected)):
+                        raise last_error
+                if not futures:
+                    launch()
+            raise last_error or RuntimeError("No endpoint available")
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+_POOLS: dict[tuple, EndpointPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _pool_for(urls: list[str], hedge: bool = HEDGE_ENABLED) -> EndpointPool:
+    key = (*urls, hedge)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = EndpointPool(urls, hedge)
+        return pool
+
+
+def _endpoint_list(value: Any, env_name: str, fallback: str) -> list[str]:
+    """Endpoints from the payload list, else the comma-separated env var, else the single endpoint."""
+    if isinstance(value, str):
+        value = value.split(",")
+    urls = [u.strip() for u in (value or []) if u and u.strip()]
+    if not urls:
+        urls = [u.strip() for u in os.getenv(env_name, "").split(",") if u.strip()]
+    if not urls and fallback:
+        urls = [fallback]
+    return list(dict.fromkeys(urls))
+
+
+class NIMEmbedding:
+    """LangChain-compatible embeddings client (duck-typed to keep imports light)."""
+
+    def __init__(
+        self,
+        endpoint: str | list[str],
+        token: str,
+        model: str,
+        max_chars: int = 2000,
+        cache: Optional[SharedCache] = EMBEDDING_CACHE,
+        query_max_chars: int = 2000,
+    ):
+        endpoints = [endpoint] if isinstance(endpoint, str) else list(endpoint)
+        self.endpoints = [e.rstrip("/") for e in endpoints]
+        self.endpoint = self.endpoints[0]
+        self.pool = _pool_for(self.endpoints)
         self.token = token
         self.model = model
         self.max_chars = max_chars
+        self.query_max_chars = query_max_chars
+        self.cache = cache
+        self.cache_hits = 0
+        self.remote_calls = 0
 
-    def _clean_text(self, text: str) -> str:
+    def _clean_text(self, text: str, max_chars: int) -> str:
         text = re.sub(r"[\x00-\x08\x0B\x0C\x0E-\x1F]", "", text).strip()
-        if len(text) > self.max_chars:
-            text = text[: self.max_chars]
+        if max_chars and len(text) > max_chars:
+            text = text[:max_chars]
         if not text:
             raise ValueError("Empty text after cleaning")
         return text
 
-    def _embed(self, text: str, input_type: str) -> list[float]:
-        text = self._clean_text(text)
-        resp = requests.post(
-            f"{self.endpoint}/embeddings",
-            headers={
-                "Authorization": f"Bearer {self.token}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": self.model,
-                "input": text,
-                "input_type": input_type,
-            },
-            timeout=60,
-            verify=False,
-        )
-        if resp.status_code != 200:
-            raise RuntimeError(f"Embedding error {resp.status_code}: {resp.text}")
-        return resp.json()["data"][0]["embedding"]
+    def _embed_many(self, texts: list[str], input_type: str) -> np.ndarray:
+        """Embed texts as rows of one matrix; uncached texts go out in a single request."""
+        max_chars = self.max_chars if input_type == "passage" else self.query_max_chars
+        texts = [self._clean_text(t, max_chars) for t in texts]
+        keys = [_sha256_bytes(f"{self.model}\0{input_type}\0{t}".encode("utf-8")) for t in texts]
+        vectors: list[Optional[np.ndarray]] = [None] * len(texts)
+        missing: list[int] = []
+        for i, key in enumerate(keys):
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                self.cache_hits += 1
+                vectors[i] = np.frombuffer(cached, dtype=np.float32)
+            else:
+                missing.append(i)
+        if not missing:
+            return np.vstack(vectors)
+        self.remote_calls += 1
+
+        def attempt(endpoint: str) -> list[list[float]]:
+            resp = requests.post(
+                f"{endpoint}/embeddings",
+                headers={
+                    "Authorization": f"Bearer {self.token}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "model": self.model,
+                    "input": [texts[i] for i in missing],
+                    "input_type": input_type,
+                },
+                timeout=_stage_timeout("embedding", 60),
+                verify=False,
+            )
+            if resp.status_code != 200:
+                raise _upstream_error("Embedding", resp.status_code, resp.text)
+            return [d["embedding"] for d in sorted(resp.json()["data"], key=lambda d: d["index"])]
+
+        for i, embedding in zip(missing, self.pool.call(attempt)):
+            vectors[i] = np.asarray(embedding, dtype=np.float32)
+            if self.cache is not None:
+                self.cache.set(keys[i], vectors[i].tobytes())
+        return np.vstack(vectors)
+
+    def _embed(self, text: str, input_type: str) -> np.ndarray:
+        return self._embed_many([text], input_type)[0]
+
+    def embed_passage_array(self, text: str) -> np.ndarray:
+        return self._embed(text, input_type="passage")
+
+    def embed_query_array(self, text: str) -> np.ndarray:
+        return self._embed(text, input_type="query")
+
+    def embed_queries_array(self, texts: list[str]) -> np.ndarray:
+        return self._embed_many(texts, input_type="query")
 
     def embed_documents(self, texts: list[str]) -> list[list[float]]:
         vectors = []
         for t in texts:
             try:
-                vectors.append(self._embed(t, input_type="passage"))
+                vectors.append(self._embed(t, input_type="passage").tolist())
+            except DeadlineExceeded:
+                raise
             except Exception:
                 continue
         return vectors
 
     def embed_query(self, text: str) -> list[float]:
-        return self._embed(text, input_type="query")
+        return self._embed(text, input_type="query").tolist()
 
 
 def _sha256_bytes(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
 
 
+# Returned on generation responses; callers send it back on later requests for
+# the same documents so a consistent-hash load balancer (Istio DestinationRule)
+# routes them to the replica whose caches are already warm.
+DOCUMENT_KEY_HEADER = "X-Document-Key"
+
+
+def _document_key(pdf_bytes_list: list[bytes]) -> str:
+    """Stable identity of a document set: independent of upload order and of
+    ingest settings, so all requests for the same PDFs share one key."""
+    return _sha256_bytes("\0".join(sorted(_sha256_bytes(b) for b in pdf_bytes_list)).encode("utf-8"))[:32]
+
+
+# ---------------------------
+# PDF downloads: content-addressed files plus a per-URL validator entry
+# ---------------------------
+PDF_DOWNLOAD_DIR = CACHE_DIR / "downloads"
+PDF_DOWNLOADS = SharedCache(CACHE_DIR / "downloads.sqlite", "downloads", max_entries=CACHE_MAX_ENTRIES)
+PDF_MAX_BYTES = int(float(os.getenv("RAG_PDF_MAX_MB", "100")) * 1024 * 1024)
+# Total size of PDF_DOWNLOAD_DIR; least recently used files are removed first
+# and their URLs are downloaded again on the next request.
+PDF_CACHE_MAX_BYTES = int(float(os.getenv("RAG_PDF_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+# A URL checked less than this many seconds ago is served without any request;
+# after that it is revalidated with a conditional GET (0 revalidates every time).
+PDF_REVALIDATE_SECONDS = float(os.getenv("RAG_PDF_REVALIDATE_SECONDS", "60"))
+DOWNLOAD_STATS = {"fresh": 0, "not_modified": 0, "downloaded": 0, "stale": 0}
+# Recently served PDFs by sha256, so fresh hits skip the disk read too.
+_PDF_BLOBS: "OrderedDict[str, bytes]" = OrderedDict()
+_PDF_BLOBS_LOCK = threading.Lock()
+_PDF_BLOB_SLOTS = 4
+
+
+def _cached_pdf(sha256: str) -> Optional[bytes]:
+    with _PDF_BLOBS_LOCK:
+        blob = _PDF_BLOBS.get(sha256)
+        if blob is not None:
+            _PDF_BLOBS.move_to_end(sha256)
+            return blob
+    path = PDF_DOWNLOAD_DIR / f"{sha256}.pdf"
+    try:
+        blob = path.read_bytes()
+        os.utime(path)  # mtime is the last use for _trim_pdf_downloads
+    except FileNotFoundError:
+        return None
+    with _PDF_BLOBS_LOCK:
+        _PDF_BLOBS[sha256] = blob
+        while len(_PDF_BLOBS) > _PDF_BLOB_SLOTS:
+            _PDF_BLOBS.popitem(last=False)
+    return blob
+
+
+def _stream_to_cache(resp: requests.Response) -> str:
+    """Write a download to PDF_DOWNLOAD_DIR while hashing it; returns its sha256."""
+    too_large = HTTPException(status_code=413, detail=f"PDF exceeds {PDF_MAX_BYTES // (1024 * 1024)} MB")
+    if int(resp.headers.get("Content-Length") or 0) > PDF_MAX_BYTES:
+        raise too_large
+    PDF_DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=PDF_DOWNLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            for block in resp.iter_content(1 << 20):
+                size += len(block)
+                if size > PDF_MAX_BYTES:
+                    raise too_large
+                digest.update(block)
+                fh.write(block)
+                _check_deadline("pdf download")
+        sha256 = digest.hexdigest()
+        os.replace(tmp, PDF_DOWNLOAD_DIR / f"{sha256}.pdf")
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return sha256
+
+
+def _trim_pdf_downloads(keep: str) -> None:
+    """Remove the least recently used PDFs beyond PDF_CACHE_MAX_BYTES."""
+    files = []
+    for path in PDF_DOWNLOAD_DIR.glob("*.pdf"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= PDF_CACHE_MAX_BYTES:
+            break
+        if path.stem != keep:
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+def _download_pdf(url: str) -> bytes:
+    """GET `url` through the download cache: fresh entries cost no request,
+    stale ones a conditional GET, and only changed documents are re-downloaded."""
+    key = _sha256_bytes(url.encode("utf-8"))
+    entry = PDF_DOWNLOADS.get_json(key)
+    if entry and time.time() - entry["checked"] < PDF_REVALIDATE_SECONDS:
+        blob = _cached_pdf(entry["sha256"])
+        if blob is not None:
+            DOWNLOAD_STATS["fresh"] += 1
+            return blob
+
+    # One revalidation per URL across workers; waiters then find a fresh entry.
+    with _process_lock(f"download-{key[:32]}"):
+        entry = PDF_DOWNLOADS.get_json(key)
+        blob = _cached_pdf(entry["sha256"]) if entry else None
+        if blob is not None and time.time() - entry["checked"] < PDF_REVALIDATE_SECONDS:
+            DOWNLOAD_STATS["fresh"] += 1
+            return blob
+        headers = {}
+        if blob is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            resp = requests.get(
+                url, headers=headers, stream=True, timeout=_stage_timeout("pdf download", 60), verify=False
+            )
+        except requests.RequestException as e:
+            if blob is None:
+                raise HTTPException(status_code=400, detail=f"Failed to download PDF: {e}")
+            logger.warning("Serving cached PDF, revalidation of %s failed: %s", url, e)
+            DOWNLOAD_STATS["stale"] += 1
+            return blob
+        with resp:
+            if resp.status_code == 304 and blob is not None:
+                PDF_DOWNLOADS.set_json(key, {**entry, "checked": time.time()})
+                DOWNLOAD_STATS["not_modified"] += 1
+                return blob
+            if resp.status_code >= 500 and blob is not None:
+                logger.warning("Serving cached PDF, %s returned %s", url, resp.status_code)
+                DOWNLOAD_STATS["stale"] += 1
+                return blob
+            if resp.status_code != 200:
+                raise HTTPException(status_code=400, detail=f"Failed to download PDF: {resp.text[:500]}")
+            sha256 = _stream_to_cache(resp)
+            _trim_pdf_downloads(keep=sha256)
+            PDF_DOWNLOADS.set_json(
+                key,
+                {
+                    "sha256": sha256,
+                    "etag": resp.headers.get("ETag", ""),
+                    "last_modified": resp.headers.get("Last-Modified", ""),
+                    "checked": time.time(),
+                },
+            )
+        DOWNLOAD_STATS["downloaded"] += 1
+        if entry and entry["sha256"] != sha256:
+            # Another URL serving the same bytes re-downloads them on its next check.
+            (PDF_DOWNLOAD_DIR / f"{entry['sha256']}.pdf").unlink(missing_ok=True)
+        return _cached_pdf(sha256)
+
+
 def _load_pdf_bytes(pdf_url: Optional[str], pdf_path: Optional[str]) -> bytes:
     if pdf_url:
-        resp = requests.get(pdf_url, timeout=60, verify=False)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=400, detail=f"Failed to download PDF: {resp.text}")
-        return resp.content
+        return _download_pdf(pdf_url)
     if pdf_path:
         path = Path(pdf_path)
         if not path.exists():
@@ -131,190 +891,2343 @@ def _load_pdfs_from_payload(pdfs: list[dict[str, str]]) -> list[bytes]:
     return blobs
 
 
-def _build_vectorstore(
-    pdf_bytes_list: list[bytes],
-    embeddings: Embeddings,
-    persist_root: Path,
-    chunk_size: int,
-    chunk_overlap: int,
-) -> Chroma:
-    combined = b"".join(pdf_bytes_list)
-    doc_hash = _sha256_bytes(combined)
-    collection_name = f"pdf-{doc_hash[:8]}"
+MINHASH_PERMUTATIONS = 64
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240611)
+_MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
 
-    chroma_url = os.getenv("RAG_CHROMA_URL", "").strip()
-    if chroma_url:
-        parsed = urlparse(chroma_url)
-        host = parsed.hostname or chroma_url
-        port = parsed.port or (443 if parsed.scheme == "https" else 80)
-        ssl = parsed.scheme == "https"
-        ssl_verify = os.getenv("RAG_CHROMA_SSL_VERIFY", "true").lower() != "false"
-        settings = Settings(chroma_server_ssl_verify=ssl_verify)
-        client = chromadb.HttpClient(
-            host=host,
-            port=port,
-            ssl=ssl,
-            settings=settings,
-        )
-        vectorstore = Chroma(
-            collection_name=collection_name,
-            embedding_function=embeddings,
-            client=client,
-        )
-    else:
-        persist_dir = persist_root / doc_hash
-        persist_dir.mkdir(parents=True, exist_ok=True)
-        vectorstore = Chroma(
-            collection_name=collection_name,
-            embedding_function=embeddings,
-            persist_directory=str(persist_dir),
-        )
 
-    if vectorstore._collection.count() > 0:
-        return vectorstore
+def _minhash_signature(text: str) -> tuple[int, ...]:
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i : i + 3]) for i in range(max(1, len(words) - 2))}
+    hashes = [zlib.crc32(sh.encode("utf-8")) for sh in shingles]
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS)
 
-    documents = []
-    for pdf_bytes in pdf_bytes_list:
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-            tmp.write(pdf_bytes)
-            tmp_path = tmp.name
-        loader = PyPDFLoader(tmp_path)
-        documents.extend(loader.load())
-
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-    )
-    chunks = splitter.split_documents(documents)
 
-    # Explicitly compute embeddings to avoid server-side embedding requirements.
-    texts: list[str] = []
-    metadatas: list[dict] = []
-    vectors: list[list[float]] = []
+def _lsh_shape(threshold: float) -> tuple[int, int]:
+    """(bands, rows) with the highest LSH S-curve midpoint (1/b)^(1/r) not above
+    the threshold; candidates are verified against the threshold afterwards."""
+    shapes = [(MINHASH_PERMUTATIONS // r, r) for r in range(1, MINHASH_PERMUTATIONS + 1) if MINHASH_PERMUTATIONS % r == 0]
+    below = [br for br in shapes if (1 / br[0]) ** (1 / br[1]) <= threshold]
+    return max(below or shapes[:1], key=lambda br: (1 / br[0]) ** (1 / br[1]))
+
+
+def _dedup_chunks(chunks: list, threshold: float) -> list:
+    """Drop near-duplicate chunks (estimated Jaccard >= threshold) in one pass
+    using MinHash signatures and an LSH band index. The kept chunk records the
+    pages of the chunks merged into it."""
+    if threshold <= 0 or len(chunks) < 2:
+        return chunks
+    bands, rows = _lsh_shape(threshold)
+    buckets: dict[tuple, list[int]] = {}
+    kept: list = []
+    signatures: list[tuple[int, ...]] = []
     for doc in chunks:
-        try:
-            embedded = embeddings.embed_documents([doc.page_content])
-        except Exception:
+        sig = _minhash_signature(doc.page_content)
+        band_keys = [(b, sig[b * rows : (b + 1) * rows]) for b in range(bands)]
+        candidates: set[int] = set()
+        for key in band_keys:
+            candidates.update(buckets.get(key, ()))
+        dup_of = None
+        for idx in sorted(candidates):
+            agree = sum(x == y for x, y in zip(sig, signatures[idx]))
+            if agree / MINHASH_PERMUTATIONS >= threshold:
+                dup_of = idx
+                break
+        if dup_of is not None:
+            target = kept[dup_of].metadata
+            page = (doc.metadata or {}).get("page")
+            if page is not None and page != target.get("page"):
+                pages = [p for p in str(target.get("duplicate_pages", "")).split(",") if p]
+                if str(page) not in pages:
+                    pages.append(str(page))
+                target["duplicate_pages"] = ",".join(pages)
             continue
-        if not embedded:
-            continue
-        texts.append(doc.page_content)
-        metadatas.append(doc.metadata or {})
-        vectors.append(embedded[0])
+        if doc.metadata is None:
+            doc.metadata = {}
+        for key in band_keys:
+            buckets.setdefault(key, []).append(len(kept))
+        kept.append(doc)
+        signatures.append(sig)
+    return kept
 
-    if texts:
-        vectorstore.add_texts(texts, metadatas=metadatas, embeddings=vectors)
 
-    return vectorstore
+VECTOR_STORE = os.getenv("RAG_VECTOR_STORE", "chroma")  # or "compact" (local only)
+VECTOR_QUANTIZATION = os.getenv("RAG_VECTOR_QUANTIZATION", "int8")  # none, float16, int8
+VECTOR_DIM = int(os.getenv("RAG_VECTOR_DIM", "0"))  # 0 keeps the model dimension
+VECTOR_REDUCTION = os.getenv("RAG_VECTOR_REDUCTION", "truncate")  # truncate (Matryoshka) or pca
+RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", "4"))
 
 
-def _extract_num_questions(user_prompt: str, default_n: int = 5) -> int:
-    match = re.search(r"\b(\d+)\b", user_prompt or "")
-    if not match:
-        return default_n
-    return int(match.group(1))
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
 
 
-def _normalize_llm_endpoint(endpoint: str) -> str:
-    endpoint = (endpoint or "").rstrip("/")
-    if endpoint.endswith("/chat/completions"):
-        return endpoint
-    if endpoint.endswith("/v1"):
-        return f"{endpoint}/chat/completions"
-    return f"{endpoint}/v1/chat/completions"
+class CompactVectorStore:
+    """Local cosine index that keeps only reduced, scalar-quantized codes in
+    RAM. Full-precision normalized vectors stay memory-mapped on disk and are
+    used to exactly re-score a shortlist of RESCORE_FACTOR * k candidates."""
 
+    def __init__(self, path: Path, embeddings: NIMEmbedding):
+        self.path = path
+        self.embeddings = embeddings
+        self.codes: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+        self.full: Optional[np.ndarray] = None
+        self.mean: Optional[np.ndarray] = None
+        self.components: Optional[np.ndarray] = None
+        self.docs: list[dict] = []
+        if (path / "docs.json").exists():
+            self._load()
 
-def _call_llm(endpoint: str, token: str, model: str, system_prompt: str, user_prompt: str) -> str:
-    if not endpoint:
-        raise HTTPException(status_code=400, detail="llm.endpoint is required")
-    endpoint = _normalize_llm_endpoint(endpoint)
-    headers = {"Content-Type": "application/json"}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    body = {
-        "model": model or "default",
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        "temperature": 0.2,
-    }
-    resp = requests.post(endpoint, headers=headers, json=body, timeout=120, verify=False)
-    if resp.status_code != 200:
-        raise HTTPException(status_code=500, detail=f"LLM error {resp.status_code}: {resp.text}")
-    data = resp.json()
-    return data.get("choices", [{}])[0].get("message", {}).get("content", "")
+    def _load(self) -> None:
+        self.docs = json.loads((self.path / "docs.json").read_text(encoding="utf-8"))
+        self.codes = np.load(self.path / "codes.npy")
+        self.full = np.load(self.path / "full.npy", mmap_mode="r")
+        if (self.path / "scales.npy").exists():
+            self.scales = np.load(self.path / "scales.npy")
+        if (self.path / "pca.npz").exists():
+            pca = np.load(self.path / "pca.npz")
+            self.mean, self.components = pca["mean"], pca["components"]
 
+    def count(self) -> int:
+        return len(self.docs)
 
-@app.post("/chat/completions")
-async def chat_completions(payload: Dict[str, Any]):
-    rag = payload.get("rag", {}) or {}
-    messages = payload.get("messages", [])
+    def _reduce(self, matrix: np.ndarray) -> np.ndarray:
+        if self.components is not None:
+            return _normalize_rows((matrix - self.mean) @ self.components.T)
+        if VECTOR_DIM and VECTOR_DIM < matrix.shape[-1]:
+            return _normalize_rows(matrix[..., :VECTOR_DIM])
+        return matrix
 
-    user_msg = next((m.get("content") for m in messages if m.get("role") == "user"), "") or ""
-    system_msg = next((m.get("content") for m in messages if m.get("role") == "system"), "") or ""
-    system_msg = system_msg or DEFAULT_SYSTEM_PROMPT
+    def add(self, texts: list[str], metadatas: list[dict], matrix: np.ndarray) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        full = _normalize_rows(matrix.astype(np.float32, copy=False))
+        if VECTOR_REDUCTION == "pca" and VECTOR_DIM and VECTOR_DIM < full.shape[1]:
+            self.mean = full.mean(axis=0)
+            _, _, vt = np.linalg.svd(full - self.mean, full_matrices=False)
+            self.components = vt[: min(VECTOR_DIM, vt.shape[0])].astype(np.float32)
+            np.savez(self.path / "pca.npz", mean=self.mean, components=self.components)
+        reduced = self._reduce(full)
+        if VECTOR_QUANTIZATION == "int8":
+            scales = np.maximum(np.abs(reduced).max(axis=1), 1e-12) / 127.0
+            codes = np.round(reduced / scales[:, None]).astype(np.int8)
+            np.save(self.path / "scales.npy", scales.astype(np.float32))
+            self.scales = scales.astype(np.float32)
+        elif VECTOR_QUANTIZATION == "float16":
+            codes = reduced.astype(np.float16)
+        else:
+            codes = reduced.astype(np.float32)
+        np.save(self.path / "codes.npy", codes)
+        np.save(self.path / "full.npy", full)
+        self.codes = codes
+        self.full = np.load(self.path / "full.npy", mmap_mode="r")
+        self.docs = [{"text": t, "metadata": m} for t, m in zip(texts, metadatas)]
+        # docs.json is written last: its presence marks a complete index.
+        tmp = self.path / "docs.json.tmp"
+        tmp.write_text(json.dumps(self.docs), encoding="utf-8")
+        os.replace(tmp, self.path / "docs.json")
 
-    n_questions = _extract_num_questions(user_msg, default_n=5)
+    def similarity_search(self, query: str, k: int = 4) -> list:
+        Document = _import("langchain_core.documents").Document
+        if not self.docs:
+            return []
+        q_full = _normalize_rows(self.embeddings.embed_query_array(query))
+        q = self._reduce(q_full)
+        approx = self.codes.astype(np.float32) @ q
+        if self.scales is not None:
+            approx *= self.scales
+        n = len(self.docs)
+        shortlist_size = min(n, max(k, k * RESCORE_FACTOR))
+        shortlist = np.argpartition(-approx, shortlist_size - 1)[:shortlist_size]
+        exact = np.asarray(self.full[np.sort(shortlist)]) @ q_full
+        order = np.sort(shortlist)[np.argsort(-exact)[:k]]
+        return [Document(page_content=self.docs[i]["text"], metadata=self.docs[i]["metadata"]) for i in order]
 
-    pdf_url = rag.get("pdf_url") or os.getenv("RAG_PDF_URL", "")
-    pdf_path = rag.get("pdf_path") or os.getenv("RAG_PDF_PATH", "")
-    pdfs_payload = rag.get("pdfs", []) or []
 
-    embedding = rag.get("embedding", {}) or {}
-    llm = rag.get("llm", {}) or {}
+class _LRU:
+    """Small thread-safe in-process LRU map of loaded indexes, by directory."""
 
-    embedding_endpoint = embedding.get("endpoint") or os.getenv("RAG_EMBEDDING_ENDPOINT", "")
-    embedding_token = embedding.get("token") or os.getenv("RAG_EMBEDDING_TOKEN", "")
-    embedding_model = embedding.get("model") or os.getenv("RAG_EMBEDDING_MODEL", "")
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self._items: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
 
-    llm_endpoint = llm.get("endpoint") or os.getenv("RAG_LLM_ENDPOINT", "")
-    llm_token = llm.get("token") or os.getenv("RAG_LLM_TOKEN", "")
-    llm_model = llm.get("model") or os.getenv("RAG_LLM_MODEL", "default")
+    def get(self, key: str) -> Any:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
 
-    chunk_size = int(rag.get("chunk_size") or os.getenv("RAG_CHUNK_SIZE", "512"))
-    chunk_overlap = int(rag.get("chunk_overlap") or os.getenv("RAG_CHUNK_OVERLAP", "64"))
-    top_k = int(rag.get("top_k") or os.getenv("RAG_TOP_K", "6"))
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.slots:
+                self._items.popitem(last=False)
 
-    if not embedding_endpoint or not embedding_model:
-        raise HTTPException(status_code=400, detail="embedding.endpoint and embedding.model are required")
 
-    pdf_bytes_list = _load_pdfs_from_payload(pdfs_payload)
-    if not pdf_bytes_list:
-        pdf_bytes_list = [_load_pdf_bytes(pdf_url, pdf_path)]
-    embeddings = NIMEmbedding(embedding_endpoint, embedding_token, embedding_model)
+# Loaded compact stores and BM25 indexes kept per worker; others are read
+# back from disk (memory-mapped for compact stores) when needed again.
+INDEX_CACHE_SLOTS = int(os.getenv("RAG_INDEX_CACHE_SLOTS", "8"))
+_COMPACT_STORES = _LRU(INDEX_CACHE_SLOTS)
 
-    persist_root = Path(os.getenv("RAG_CHROMA_DIR", "/data/chroma"))
-    vectorstore = _build_vectorstore(pdf_bytes_list, embeddings, persist_root, chunk_size, chunk_overlap)
 
-    docs = vectorstore.similarity_search(user_msg or "quiz questions", k=top_k)
-    context = "\n\n".join(d.page_content for d in docs)
+def _vector_layout() -> str:
+    if VECTOR_STORE != "compact" or os.getenv("RAG_CHROMA_URL", "").strip():
+        return "chroma"
+    return f"compact:{VECTOR_QUANTIZATION}:{VECTOR_REDUCTION}:{VECTOR_DIM}"
 
-    prompt = STRICT_JSON_PROMPT.format(n=n_questions, context=context)
 
-    content = _call_llm(llm_endpoint, llm_token, llm_model, system_msg, prompt)
-    match = re.search(r"\[[\s\S]*\]", content or "")
-    if not match:
-        raise HTTPException(status_code=500, detail="LLM did not return a JSON array")
+def _store_count(vectorstore) -> int:
+    if isinstance(vectorstore, CompactVectorStore):
+        return vectorstore.count()
+    return vectorstore._collection.count()
 
-    json_text = match.group(0)
+
+# ---------------------------
+# Lexical retrieval: Okapi BM25 over the same chunks as the vector index
+# ---------------------------
+# Bump when tokenization or the on-disk layout changes; older files are rebuilt.
+LEXICAL_VERSION = "bm25-1"
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+RETRIEVAL_MODES = ("vector", "bm25", "hybrid", "auto")
+RETRIEVAL_STATS = {"vector": 0, "bm25": 0, "hybrid": 0, "fallback": 0}
+
+_BM25_TOKEN_RE = re.compile(r"\w+")
+_BM25_STOPWORDS = frozenset(
+    "a about an and are as at be by can for from has have how in into is it its of on or "
+    "that the their this to was were what when which who will with".split()
+)
+# "10 questions", "5 multiple-choice questions": the count says nothing about the topic.
+_QUESTION_COUNT_RE = re.compile(r"\b\d+\s+(?:multiple[- ]choice\s+)?(?:questions?|mcqs?)\b", re.I)
+_BM25_INDEXES = _LRU(INDEX_CACHE_SLOTS)
+
+
+def _bm25_terms(text: str) -> list[str]:
+    return [t for t in _BM25_TOKEN_RE.findall(text.lower()) if t not in _BM25_STOPWORDS]
+
+
+def _query_terms(query: str) -> list[str]:
+    """Topic terms of a quiz prompt: without the question count and request boilerplate."""
+    terms = _bm25_terms(_QUESTION_COUNT_RE.sub(" ", query or ""))
+    return list(dict.fromkeys(t for t in terms if t not in _GENERIC_PROMPT_WORDS))
+
+
+class BM25Index:
+    """Inverted index in CSR layout: the postings of term id t are
+    doc_ids[offsets[t]:offsets[t + 1]] with term frequencies tfs[...], so a
+    query touches only the arrays of its own terms."""
+
+    def __init__(
+        self,
+        terms: list[str],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_len: np.ndarray,
+        docs: list[dict],
+    ):
+        self.vocab = {t: i for i, t in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.docs = docs
+        n = len(doc_len)
+        df = np.diff(offsets).astype(np.float32)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_len = float(doc_len.mean()) if n else 1.0
+        # Per-document part of the BM25 denominator, precomputed once.
+        self.norm = (BM25_K1 * (1.0 - BM25_B + BM25_B * doc_len / max(avg_len, 1e-9))).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts: list[str], metadatas: list[dict]) -> "BM25Index":
+        postings: dict[str, list[tuple[int, int]]] = {}
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            terms = _bm25_terms(text)
+            doc_len[doc_id] = len(terms)
+            counts: dict[str, int] = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[t]) for t in terms])
+        flat = [pair for t in terms for pair in postings[t]]
+        doc_ids = np.fromiter((d for d, _ in flat), dtype=np.int32, count=len(flat))
+        tfs = np.fromiter((min(tf, 65535) for _, tf in flat), dtype=np.uint16, count=len(flat))
+        docs = [{"text": t, "metadata": m} for t, m in zip(texts, metadatas)]
+        return cls(terms, offsets, doc_ids, tfs, doc_len, docs)
+
+    def save(self, path: Path) -> None:
+        path.mkdir(parents=True, exist_ok=True)
+        terms = sorted(self.vocab, key=self.vocab.get)
+        np.savez(
+            path / f"{LEXICAL_VERSION}.npz",
+            terms=np.array(terms, dtype=str),
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            tfs=self.tfs,
+            doc_len=self.doc_len,
+        )
+        # The docs file is written last: its presence marks a complete index.
+        tmp = path / f"{LEXICAL_VERSION}.docs.json.tmp"
+        tmp.write_text(json.dumps(self.docs), encoding="utf-8")
+        os.replace(tmp, path / f"{LEXICAL_VERSION}.docs.json")
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["BM25Index"]:
+        if not (path / f"{LEXICAL_VERSION}.docs.json").exists():
+            return None
+        arrays = np.load(path / f"{LEXICAL_VERSION}.npz")
+        docs = json.loads((path / f"{LEXICAL_VERSION}.docs.json").read_text(encoding="utf-8"))
+        return cls(
+            arrays["terms"].tolist(), arrays["offsets"], arrays["doc_ids"], arrays["tfs"], arrays["doc_len"], docs
+        )
+
+    def search(self, query: str, k: int) -> list[int]:
+        """Ids of the top-k chunks by BM25 score; empty when no query term occurs."""
+        term_ids = [self.vocab[t] for t in _query_terms(query) if t in self.vocab]
+        if not term_ids or not self.docs:
+            return []
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        for t in term_ids:
+            lo, hi = self.offsets[t], self.offsets[t + 1]
+            docs = self.doc_ids[lo:hi]
+            tf = self.tfs[lo:hi].astype(np.float32)
+            # A term lists each document once, so plain fancy-index += is safe.
+            scores[docs] += self.idf[t] * tf * (BM25_K1 + 1.0) / (tf + self.norm[docs])
+        hits = np.flatnonzero(scores)
+        k = min(k, len(hits))
+        top = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        return top[np.argsort(-scores[top])].tolist()
+
+    def spread(self, k: int) -> list[int]:
+        """k chunks evenly spaced through the documents, for prompts without a topic."""
+        if not self.docs:
+            return []
+        return sorted(set(np.linspace(0, len(self.docs) - 1, num=min(k, len(self.docs))).round().astype(int).tolist()))
+
+    def documents(self, ids: list[int]) -> list:
+        Document = _import("langchain_core.documents").Document
+        return [Document(page_content=self.docs[i]["text"], metadata=self.docs[i]["metadata"]) for i in ids]
+
+
+def _lexical_index(persist_dir: Path, vectorstore) -> BM25Index:
+    """The BM25 index next to a vector index; built from the stored chunks for
+    indexes ingested before lexical retrieval existed."""
+    index = _BM25_INDEXES.get(str(persist_dir))
+    if index is not None:
+        return index
+    index = BM25Index.load(persist_dir)
+    if index is None:
+        with _process_lock(f"lexical-{persist_dir.name}"):
+            index = BM25Index.load(persist_dir)
+            if index is None:
+                if isinstance(vectorstore, CompactVectorStore):
+                    texts = [d["text"] for d in vectorstore.docs]
+                    metadatas = [d["metadata"] for d in vectorstore.docs]
+                else:
+                    stored = vectorstore._collection.get(include=["documents", "metadatas"])
+                    texts, metadatas = stored["documents"], [m or {} for m in stored["metadatas"]]
+                index = BM25Index.build(texts, metadatas)
+                index.save(persist_dir)
+    _BM25_INDEXES.put(str(persist_dir), index)
+    return index
+
+
+def _reciprocal_rank_fusion(rankings: list[list], k: int) -> list:
+    """Fuse ranked Document lists by sum of 1 / (RRF_K + rank)."""
+    scores: dict[str, float] = {}
+    docs: dict[str, Any] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1.0 / (RRF_K + rank + 1)
+            docs.setdefault(doc.page_content, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+def _search_chunks(vectorstore, lexical: BM25Index, query: str, k: int, mode: str) -> list:
+    """Top-k chunks for `query` by `mode`. "auto" answers prompts with topic terms
+    from BM25 alone (no query embedding); any mode falls back to BM25 when the
+    query cannot be embedded."""
+    keyword_hits = lexical.search(query, k * 2 if mode == "hybrid" else k) if mode != "vector" else []
+    if mode == "bm25" or (mode == "auto" and keyword_hits):
+        RETRIEVAL_STATS["bm25"] += 1
+        return lexical.documents(keyword_hits[:k] or lexical.spread(k))
     try:
-        parsed = json.loads(json_text)
-        if len(parsed) != n_questions:
-            raise ValueError("Wrong number of questions")
-        for q in parsed:
-            if set(q.keys()) != {"id", "question", "options", "correctIndex"}:
-                raise ValueError("Invalid question keys")
-            if len(q["options"]) != 4:
-                raise ValueError("Each question must have 4 options")
-            if q["correctIndex"] not in [0, 1, 2, 3]:
-                raise ValueError("correctIndex must be 0-3")
+        vector_docs = vectorstore.similarity_search(query, k=k * 2 if mode == "hybrid" else k)
+    except DeadlineExceeded:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.warning("Vector search failed, serving BM25 results: %s", e)
+        RETRIEVAL_STATS["fallback"] += 1
+        hits = keyword_hits or lexical.search(query, k)
+        return lexical.documents(hits[:k] or lexical.spread(k))
+    if mode == "hybrid" and keyword_hits:
+        RETRIEVAL_STATS["hybrid"] += 1
+        return _reciprocal_rank_fusion([vector_docs, lexical.documents(keyword_hits)], k)
+    RETRIEVAL_STATS["vector"] += 1
+    return vector_docs[:k]
 
-    return {"choices": [{"message": {"content": json_text}}]}
 
+# ---------------------------
+# Chunking: "recursive" sizes chunks in characters (langchain); "token" sizes
+# them in embedding-tokenizer tokens so chunks fit the model without truncation
+# (exactly with RAG_TOKENIZER, by estimate otherwise).
+# ---------------------------
+SPLITTER = os.getenv("RAG_SPLITTER", "recursive").lower()
+EMBEDDING_MAX_TOKENS = int(os.getenv("RAG_EMBEDDING_MAX_TOKENS", "512"))
+# tokenizer.json path or Hugging Face repo id of the embedding model's tokenizer;
+# unset falls back to a WordPiece-style estimate (see _char_costs).
+TOKENIZER = os.getenv("RAG_TOKENIZER", "").strip()
 
-@app.get("/healthz")
-def healthz():
-    return {"ok": True}
+_PUNCTUATION = "!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~"
+_ASCII_PUNCTUATION = np.zeros(128, dtype=bool)
+_ASCII_PUNCTUATION[[ord(c) for c in _PUNCTUATION]] = True
+_ASCII_SENTENCE_END = np.zeros(128, dtype=bool)
+_ASCII_SENTENCE_END[[ord(c) for c in ".!?"]] = True
+# Full-width sentence ends (CJK text has no space after them).
+_WIDE_SENTENCE_END = [ord(c) for c in "\u3002\uff01\uff1f"]
+_WORD_SPLIT_RE = re.compile(r"\s+")
+_TOKENIZER_OBJ = None
+
+
+def _codes(text: str) -> np.ndarray:
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+
+def _char_costs(codes: np.ndarray) -> np.ndarray:
+    """Estimated tokens contributed by each character (code point) of a text,
+    in sixths of a token so sums stay exact integers.
+
+    WordPiece splits on whitespace and punctuation and breaks long or rare
+    words into pieces; CJK and most other non-Latin scripts come out at about
+    one token per character. So: one token per punctuation mark and per
+    non-ASCII character, one per run of ASCII letters/digits plus one per six
+    of its characters. The costs add up, so the estimate of any slice is a
+    difference of prefix sums.
+    """
+    ascii_codes = codes < 128
+    space = codes <= 32
+    punctuation = ascii_codes & _ASCII_PUNCTUATION[np.minimum(codes, 127)]
+    letter = ascii_codes & ~space & ~punctuation
+    run_start = letter.copy()
+    run_start[1:] &= ~letter[:-1]
+    return letter.view(np.uint8) + 6 * (run_start | punctuation | ~ascii_codes).view(np.uint8)
+
+
+def _estimate_tokens(text: str) -> int:
+    return -(-int(_char_costs(_codes(text)).sum(dtype=np.int64)) // 6)
+
+
+def _tokenizer():
+    global _TOKENIZER_OBJ
+    if _TOKENIZER_OBJ is None:
+        Tokenizer = _import("tokenizers").Tokenizer
+        if Path(TOKENIZER).exists():
+            _TOKENIZER_OBJ = Tokenizer.from_file(TOKENIZER)
+        else:
+            _TOKENIZER_OBJ = Tokenizer.from_pretrained(TOKENIZER)
+    return _TOKENIZER_OBJ
+
+
+def _token_counter() -> Callable[[list[str]], list[int]]:
+    """Batch token counter for the embedding model's tokenizer."""
+    if not TOKENIZER:
+        return lambda texts: [_estimate_tokens(t) for t in texts]
+    tokenizer = _tokenizer()
+    return lambda texts: [len(e.ids) for e in tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+
+def _token_prefix(text: str, codes: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+    """Tokenize `text` (code points `codes`) once; the returned function maps
+    character offsets to the number of tokens before them."""
+    if TOKENIZER:
+        offsets = _tokenizer().encode(text, add_special_tokens=False).offsets
+        starts = np.fromiter((start for start, _ in offsets), dtype=np.int64, count=len(offsets))
+        return lambda positions: np.searchsorted(starts, positions, side="left").astype(np.float64)
+    prefix = np.concatenate(([0], np.cumsum(_char_costs(codes), dtype=np.int64))) / 6.0
+    return lambda positions: prefix[positions]
+
+
+def _boundaries(codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Offsets where sentences and paragraphs start: after whitespace that
+    follows . ! ? (paragraphs: whitespace holding two or more line breaks),
+    and right after a full-width sentence end."""
+    space = codes <= 32
+    # Starts of text after whitespace, and the last character before that whitespace.
+    starts = np.flatnonzero(space[:-1] & ~space[1:]) + 1
+    run_starts = np.flatnonzero(~space[:-1] & space[1:]) + 1
+    if len(run_starts) and len(starts) and run_starts[0] > starts[0]:
+        starts = starts[1:]  # text opening with whitespace (not after strip())
+    before = run_starts[: len(starts)] - 1
+    newlines = np.concatenate(([0], np.cumsum(codes == 10)))
+    is_paragraph = newlines[starts] - newlines[before + 1] >= 2
+    end_code = codes[before]
+    is_sentence = is_paragraph | ((end_code < 128) & _ASCII_SENTENCE_END[np.minimum(end_code, 127)])
+    sentences, paragraphs = starts[is_sentence], starts[is_paragraph]
+    if codes.max() >= 0x3002:
+        wide = np.zeros(len(codes) + 1, dtype=bool)
+        for code in _WIDE_SENTENCE_END:
+            wide[1:] |= codes == code
+        wide[-1] = False
+        wide[1:-1] &= ~space[1:]
+        wide[sentences] = True
+        sentences = np.flatnonzero(wide)
+    return sentences, paragraphs
+
+
+class SentenceTokenSplitter:
+    """Splitter packing whole sentences into chunks of at most
+    ``chunk_tokens`` tokens, closing chunks early at paragraph breaks.
+
+    A batch of texts (pages) is tokenized in one pass; chunk sizes are
+    differences of token counts at candidate cut positions (sentence starts)
+    and chunks are slices of the original text, never spanning two texts. The
+    trailing sentences of a chunk, up to ``overlap_tokens``, open the next
+    one. Only a sentence longer than a whole chunk is cut, at word
+    boundaries, and only a word longer than a chunk is cut inside.
+    """
+
+    def __init__(self, chunk_tokens: int, overlap_tokens: int):
+        # Leave room for the [CLS]/[SEP] tokens the embedding model adds.
+        self.limit = max(16, min(chunk_tokens, EMBEDDING_MAX_TOKENS - 2))
+        self.overlap = max(0, min(overlap_tokens, self.limit // 2))
+
+    def _refine(self, text: str, cuts: np.ndarray, tokens: np.ndarray, prefix, pattern) -> tuple:
+        """Add cut positions inside segments longer than a chunk: at `pattern`
+        matches, or at every character when `pattern` is None."""
+        extra: list[int] = []
+        for i in np.flatnonzero(np.diff(tokens) > self.limit):
+            lo, hi = int(cuts[i]), int(cuts[i + 1])
+            if pattern is None:
+                extra.extend(range(lo + 1, hi))
+            else:
+                extra.extend(m.end() for m in pattern.finditer(text, lo, hi) if m.end() < hi)
+        if not extra:
+            return cuts, tokens
+        cuts = np.union1d(cuts, np.array(extra, dtype=np.int64))
+        return cuts, prefix(cuts)
+
+    def _pack(self, text: str, cuts: np.ndarray, tokens: np.ndarray, paragraphs: np.ndarray, start: int, last: int, limit: float) -> Iterator[str]:
+        """Chunks of text[cuts[start]:cuts[last]]."""
+        while start < last:
+            end = max(start + 1, int(tokens.searchsorted(tokens[start] + limit, side="right")) - 1)
+            end = min(end, last)
+            # Close at the first paragraph break once the chunk is half full.
+            half = int(tokens.searchsorted(tokens[start] + limit / 2, side="left"))
+            i = int(paragraphs.searchsorted(max(half, start + 1)))
+            at_paragraph = i < len(paragraphs) and paragraphs[i] < end
+            if at_paragraph:
+                end = int(paragraphs[i])
+            chunk = text[cuts[start] : cuts[end]].strip()
+            if chunk:
+                yield chunk
+            if end == last:
+                return
+            if at_paragraph:
+                start = end
+                continue
+            # Carry trailing sentences up to the overlap, as long as the next
+            # segment still fits after them.
+            carried = max(
+                int(tokens.searchsorted(tokens[end] - self.overlap, side="left")),
+                int(tokens.searchsorted(tokens[end + 1] - limit, side="left")),
+            )
+            start = max(carried, start + 1)
+
+    def split_texts(self, texts: list[str]) -> list[list[str]]:
+        texts = [t.strip() for t in texts]
+        joined = "\n\n".join(texts)
+        if not joined:
+            return [[] for _ in texts]
+        lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        starts = np.concatenate(([0], np.cumsum(lengths + 2)[:-1]))
+        ends = starts + lengths
+        codes = _codes(joined)
+        prefix = _token_prefix(joined, codes)
+        sentence_starts, paragraph_starts = _boundaries(codes)
+        cuts = np.unique(np.concatenate((starts, ends, sentence_starts)))
+        tokens = prefix(cuts)
+        cuts, tokens = self._refine(joined, cuts, tokens, prefix, _WORD_SPLIT_RE)
+        word_cuts = len(cuts)
+        cuts, tokens = self._refine(joined, cuts, tokens, prefix, None)
+        # A slice starting inside a word opens a new word piece: one token more.
+        limit = self.limit if len(cuts) == word_cuts else self.limit - 1
+        paragraphs = cuts.searchsorted(paragraph_starts)
+        firsts, lasts = cuts.searchsorted(starts), cuts.searchsorted(ends)
+        chunks: list[list[str]] = []
+        for text, first, last in zip(texts, firsts.tolist(), lasts.tolist()):
+            if not text:
+                chunks.append([])
+            elif tokens[last] - tokens[first] <= limit:
+                chunks.append([text])
+            else:
+                chunks.append(list(self._pack(joined, cuts, tokens, paragraphs, first, last, limit)))
+        return chunks
+
+    def split_text(self, text: str) -> list[str]:
+        return self.split_texts([text])[0]
+
+
+def _make_splitter(chunk_size: int, chunk_overlap: int):
+    if SPLITTER == "token":
+        return SentenceTokenSplitter(chunk_size, chunk_overlap)
+    RecursiveCharacterTextSplitter = _import("langchain_text_splitters").RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def _splitter_id() -> str:
+    """Everything about chunking that chunk_size/chunk_overlap do not capture."""
+    if SPLITTER == "token":
+        return f"token-2:{TOKENIZER or 'estimate'}:{EMBEDDING_MAX_TOKENS}"
+    return "recursive-1"
+
+
+# Bump when page text extraction changes so cached parses are not reused.
+EXTRACTOR_VERSION = "pypdf-2"
+
+
+def _index_key(
+    doc_hashes: list[str],
+    chunk_size: int,
+    chunk_overlap: int,
+    dedup_threshold: float,
+    embedding_model: str,
+) -> str:
+    """Identity of a chunk+vector index: every input that changes its contents."""
+    spec = {
+        "docs": doc_hashes,
+        "extractor": EXTRACTOR_VERSION,
+        "splitter": _splitter_id(),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "dedup_threshold": dedup_threshold,
+        "embedding_model": embedding_model,
+        "vectors": _vector_layout(),
+    }
+    return _sha256_bytes(json.dumps(spec, sort_keys=True).encode("utf-8"))
+
+
+def _parsed_pages(pdf_bytes: bytes, doc_hash: str) -> list[dict]:
+    """Page texts of one PDF, parsed once per (doc hash, extractor version)."""
+    cache_key = f"{doc_hash}:{EXTRACTOR_VERSION}"
+    pages = PARSED_PAGES.get_json(cache_key)
+    if pages is not None:
+        return pages
+
+    PyPDFLoader = _import("langchain_community.document_loaders").PyPDFLoader
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(pdf_bytes)
+        tmp_path = tmp.name
+    try:
+        loaded = PyPDFLoader(tmp_path).load()
+    finally:
+        os.unlink(tmp_path)
+    pages = [
+        {"page": d.metadata.get("page", i), "text": d.page_content, "hash": _sha256_bytes(d.page_content.encode("utf-8"))}
+        for i, d in enumerate(loaded)
+    ]
+    PARSED_PAGES.set_json(cache_key, pages)
+    return pages
+
+
+# With a remote Chroma the page owners are also kept there, so a revision is
+# recognised on any pod, not only the one that ingested the previous version.
+PAGE_OWNERS_COLLECTION = "rag-page-owners"
+
+
+def _remote_page_owners():
+    client = _chroma_http_client()
+    if client is None:
+        return None
+    # One-dimensional placeholder vectors: the collection is only read by id.
+    return client.get_or_create_collection(PAGE_OWNERS_COLLECTION, embedding_function=None)
+
+
+def _page_owners(page_hashes: list[str]) -> dict[str, str]:
+    owners = {}
+    for page_hash in page_hashes:
+        owner = PAGE_OWNERS.get(page_hash)
+        if owner is not None:
+            owners[page_hash] = owner.decode()
+    missing = [h for h in page_hashes if h not in owners]
+    if missing:
+        try:
+            remote = _remote_page_owners()
+            if remote is not None:
+                found = remote.get(ids=missing, include=["metadatas"])
+                owners.update({h: m["doc"] for h, m in zip(found["ids"], found["metadatas"])})
+        except Exception as e:
+            logger.warning("Remote page owner lookup failed: %s", e)
+    return owners
+
+
+def _record_page_owners(doc_hash: str, page_hashes: list[str]) -> None:
+    for page_hash in page_hashes:
+        PAGE_OWNERS.set(page_hash, doc_hash.encode())
+    try:
+        remote = _remote_page_owners()
+        if remote is not None:
+            remote.upsert(
+                ids=page_hashes,
+                embeddings=[[0.0]] * len(page_hashes),
+                metadatas=[{"doc": doc_hash}] * len(page_hashes),
+            )
+    except Exception as e:
+        logger.warning("Recording remote page owners failed: %s", e)
+
+
+def _match_revision(doc_hash: str, page_hashes: list[str]) -> Optional[Dict[str, Any]]:
+    """Find the previously ingested document sharing the most pages with this
+    one and record this document's pages for future matches."""
+    unique = list(dict.fromkeys(page_hashes))
+    overlap: dict[str, int] = {}
+    for owner in _page_owners(unique).values():
+        if owner != doc_hash:
+            overlap[owner] = overlap.get(owner, 0) + 1
+    _record_page_owners(doc_hash, unique)
+    if not overlap:
+        return None
+    previous, shared = max(overlap.items(), key=lambda kv: kv[1])
+    return {"revision_of": previous, "unchanged_pages": shared, "changed_pages": len(page_hashes) - shared}
+
+
+def _pages_chunks(pages: list[dict], splitter, chunk_size: int, chunk_overlap: int) -> list[list[str]]:
+    """Chunk texts of each page, split once per (page content hash, chunking params).
+    Chunks never span pages, so an unchanged page in a revised PDF is not re-split,
+    and its vectors come back from the embedding cache. Uncached pages are split
+    in one batch."""
+    keys = [f"{page['hash']}:{_splitter_id()}:{chunk_size}:{chunk_overlap}" for page in pages]
+    chunks = [PAGE_CHUNKS.get_json(key) for key in keys]
+    missing = [i for i, texts in enumerate(chunks) if texts is None]
+    if missing:
+        if isinstance(splitter, SentenceTokenSplitter):
+            split = splitter.split_texts([pages[i]["text"] for i in missing])
+        else:
+            split = [splitter.split_text(pages[i]["text"]) for i in missing]
+        for i, texts in zip(missing, split):
+            chunks[i] = texts
+            PAGE_CHUNKS.set_json(keys[i], texts)
+    return chunks
+
+
+def _chroma_http_client():
+    """Client of the remote Chroma (RAG_CHROMA_URL), or None for local indexes."""
+    chroma_url = os.getenv("RAG_CHROMA_URL", "").strip()
+    if not chroma_url:
+        return None
+    chromadb = _import("chromadb")
+    Settings = _import("chromadb.config").Settings
+    parsed = urlparse(chroma_url)
+    host = parsed.hostname or chroma_url
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    ssl = parsed.scheme == "https"
+    ssl_verify = os.getenv("RAG_CHROMA_SSL_VERIFY", "true").lower() != "false"
+    settings = Settings(chroma_server_ssl_verify=ssl_verify)
+    return chromadb.HttpClient(
+        host=host,
+        port=port,
+        ssl=ssl,
+        settings=settings,
+    )
+
+
+def _revision_vectors(
+    previous_doc: str,
+    embeddings: NIMEmbedding,
+    persist_root: Path,
+    chunk_size: int,
+    chunk_overlap: int,
+    dedup_threshold: float,
+) -> dict[str, np.ndarray]:
+    """Chunk text -> vector from the previous revision's index, if it was built
+    with the same settings; unchanged pages split into the same chunk texts."""
+    index_key = _index_key([previous_doc], chunk_size, chunk_overlap, dedup_threshold, embeddings.model)
+    persist_dir = persist_root / index_key
+    try:
+        if _vector_layout() != "chroma":
+            if not (persist_dir / "docs.json").exists():
+                return {}
+            store = _open_vectorstore(f"idx-{index_key[:24]}", persist_dir, embeddings)
+            return {d["text"]: np.asarray(store.full[i]) for i, d in enumerate(store.docs)}
+        client = _chroma_http_client()
+        if client is None:
+            if not persist_dir.exists():
+                return {}
+            collection = _open_vectorstore(f"idx-{index_key[:24]}", persist_dir, embeddings)._collection
+        else:
+            names = {getattr(c, "name", c) for c in client.list_collections()}
+            if f"idx-{index_key[:24]}" not in names:
+                return {}
+            collection = client.get_collection(f"idx-{index_key[:24]}", embedding_function=None)
+        stored = collection.get(where={"source": previous_doc[:16]}, include=["documents", "embeddings"])
+        return {t: np.asarray(e, dtype=np.float32) for t, e in zip(stored["documents"], stored["embeddings"])}
+    except Exception as e:
+        logger.warning("Could not read the previous revision's vectors: %s", e)
+        return {}
+
+
+def _open_vectorstore(collection_name: str, persist_dir: Path, embeddings: NIMEmbedding):
+    if _vector_layout() != "chroma":
+        store = _COMPACT_STORES.get(str(persist_dir))
+        if store is None or store.count() == 0:
+            store = CompactVectorStore(persist_dir, embeddings)
+            _COMPACT_STORES.put(str(persist_dir), store)
+        store.embeddings = embeddings
+        return store
+
+    Chroma = _import("langchain_community.vectorstores").Chroma
+
+    client = _chroma_http_client()
+    if client is not None:
+        return Chroma(
+            collection_name=collection_name,
+            embedding_function=embeddings,
+            client=client,
+        )
+    persist_dir.mkdir(parents=True, exist_ok=True)
+    return Chroma(
+        collection_name=collection_name,
+        embedding_function=embeddings,
+        persist_directory=str(persist_dir),
+    )
+
+
+INGEST_STATS = {"dropped_chunks": 0}
+
+
+def _build_vectorstore(
+    pdf_bytes_list: list[bytes],
+    embeddings: NIMEmbedding,
+    persist_root: Path,
+    chunk_size: int,
+    chunk_overlap: int,
+    dedup_threshold: float = 0.0,
+):
+    Document = _import("langchain_core.documents").Document
+
+    doc_hashes = [_sha256_bytes(b) for b in pdf_bytes_list]
+    index_key = _index_key(doc_hashes, chunk_size, chunk_overlap, dedup_threshold, embeddings.model)
+    collection_name = f"idx-{index_key[:24]}"
+    vectorstore = _open_vectorstore(collection_name, persist_root / index_key, embeddings)
+
+    if _store_count(vectorstore) > 0:
+        return vectorstore
+
+    # Serialize ingestion of the same index across worker processes; the
+    # loser of the race re-checks the collection and reuses the winner's work.
+    with _process_lock(f"ingest-{index_key}"):
+        if _store_count(vectorstore) > 0:
+            return vectorstore
+
+        splitter = _make_splitter(chunk_size, chunk_overlap)
+        chunks = []
+        revisions = []
+        previous_vectors: dict[str, np.ndarray] = {}
+        for pdf_bytes, doc_hash in zip(pdf_bytes_list, doc_hashes):
+            pages = _parsed_pages(pdf_bytes, doc_hash)
+            revision = _match_revision(doc_hash, [page["hash"] for page in pages])
+            if revision is not None:
+                revisions.append({"doc": doc_hash, **revision})
+                previous_vectors.update(
+                    _revision_vectors(
+                        revision["revision_of"], embeddings, persist_root, chunk_size, chunk_overlap, dedup_threshold
+                    )
+                )
+            for page, page_chunks in zip(pages, _pages_chunks(pages, splitter, chunk_size, chunk_overlap)):
+                for text in page_chunks:
+                    chunks.append(
+                        Document(page_content=text, metadata={"source": doc_hash[:16], "page": page["page"]})
+                    )
+        chunks = _dedup_chunks(chunks, dedup_threshold)
+
+        # Explicitly compute embeddings to avoid server-side embedding requirements.
+        texts: list[str] = []
+        metadatas: list[dict] = []
+        vectors: list[np.ndarray] = []
+        dropped = 0
+        copied = 0
+        first_error: Optional[Exception] = None
+        for doc in chunks:
+            # Chunks of pages unchanged since the previous revision take its
+            # vectors, which works even when the embedding cache is cold.
+            vector = previous_vectors.get(doc.page_content)
+            if vector is not None:
+                copied += 1
+            else:
+                try:
+                    vector = embeddings.embed_passage_array(doc.page_content)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    dropped += 1
+                    first_error = first_error or e
+                    continue
+            texts.append(doc.page_content)
+            metadatas.append(doc.metadata or {})
+            vectors.append(vector)
+
+        if dropped:
+            INGEST_STATS["dropped_chunks"] += dropped
+            logger.warning("Dropped %d of %d chunks that could not be embedded: %s", dropped, len(chunks), first_error)
+
+        if texts:
+            _check_deadline("vector store write")
+            matrix = np.vstack(vectors).astype(np.float32, copy=False)
+            if isinstance(vectorstore, CompactVectorStore):
+                vectorstore.add(texts, metadatas, matrix)
+            else:
+                # Upsert the float32 matrix directly; add_texts would re-embed
+                # every text and round-trip the vectors through Python lists.
+                vectorstore._collection.upsert(
+                    ids=[f"{index_key[:16]}-{i}" for i in range(len(texts))],
+                    embeddings=matrix,
+                    documents=texts,
+                    metadatas=metadatas,
+                )
+
+        lexical = BM25Index.build(texts, metadatas)
+        lexical.save(persist_root / index_key)
+        _BM25_INDEXES.put(str(persist_root / index_key), lexical)
+
+        INDEX_REGISTRY.set_json(
+            index_key,
+            {
+                "collection": collection_name,
+                "docs": doc_hashes,
+                "chunks": len(texts),
+                "dropped_chunks": dropped,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "dedup_threshold": dedup_threshold,
+                "embedding_model": embeddings.model,
+                "copied_vectors": copied,
+                "reused_vectors": embeddings.cache_hits,
+                "embedded_vectors": embeddings.remote_calls,
+                "revisions": revisions,
+                "created_at": time.time(),
+            },
+        )
+
+    return vectorstore
+
+
+def _extract_num_questions(user_prompt: str, default_n: int = 5) -> int:
+    match = re.search(r"\b(\d+)\b", user_prompt or "")
+    if not match:
+        return default_n
+    return int(match.group(1))
+
+
+def _normalize_llm_endpoint(endpoint: str) -> str:
+    endpoint = (endpoint or "").rstrip("/")
+    if endpoint.endswith("/chat/completions"):
+        return endpoint
+    if endpoint.endswith("/v1"):
+        return f"{endpoint}/chat/completions"
+    return f"{endpoint}/v1/chat/completions"
+
+
+async def _call_llm(
+    endpoints: list[str],
+    token: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    params: Optional[Dict[str, Any]] = None,
+) -> tuple[str, Dict[str, Any]]:
+    """Return the completion text and its usage (token counts plus finish_reason)."""
+    if not endpoints:
+        raise HTTPException(status_code=400, detail="llm.endpoint is required")
+    pool = _pool_for([_normalize_llm_endpoint(e) for e in endpoints], hedge=LLM_HEDGE_ENABLED)
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    body = {
+        "model": model or "default",
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        "temperature": 0.2,
+        **(params or {}),
+    }
+
+    async def attempt(endpoint: str) -> tuple[str, Dict[str, Any]]:
+        resp = await _http_client().post(endpoint, headers=headers, json=body, timeout=_stage_timeout("llm", 120))
+        if resp.status_code != 200:
+            raise _upstream_error("LLM", resp.status_code, resp.text)
+        data = resp.json()
+        choice = data.get("choices", [{}])[0]
+        usage = {**(data.get("usage") or {}), "finish_reason": choice.get("finish_reason")}
+        return choice.get("message", {}).get("content", ""), usage
+
+    try:
+        return await pool.acall(attempt)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"LLM request failed: {type(e).__name__}: {e}")
+
+
+# ---------------------------
+# Generation profiles: latency/quality presets for one quiz generation
+# ---------------------------
+# max_tokens = reasoning_tokens + n * tokens_per_question; context_tokens caps
+# the retrieved context (embedding-tokenizer tokens) by dropping the
+# lowest-ranked chunks. RAG_GENERATION_PROFILES (JSON) overrides fields per name.
+# reasoning_effort, max_tokens and stop are only sent when a profile sets them:
+# "balanced" sends the plain request every chat-completions endpoint accepts,
+# non-reasoning models reject reasoning_effort.
+GENERATION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "fast": {
+        "reasoning_effort": "low",
+        "reasoning_tokens": 1024,
+        "tokens_per_question": 120,
+        "context_tokens": 1024,
+        "top_k": 3,
+        "stop": ["\n```", "\n\n\n"],
+    },
+    "balanced": {
+        "reasoning_effort": "",
+        "reasoning_tokens": 0,
+        "tokens_per_question": 0,
+        "context_tokens": 4096,
+        "top_k": int(os.getenv("RAG_TOP_K", "6")),
+        "stop": [],
+    },
+    "thorough": {
+        "reasoning_effort": "high",
+        "reasoning_tokens": 12288,
+        "tokens_per_question": 220,
+        "context_tokens": 8192,
+        "top_k": 10,
+        "stop": [],
+    },
+}
+for _name, _overrides in json.loads(os.getenv("RAG_GENERATION_PROFILES", "") or "{}").items():
+    GENERATION_PROFILES[_name] = {**GENERATION_PROFILES.get(_name, GENERATION_PROFILES["balanced"]), **_overrides}
+GENERATION_PROFILE = os.getenv("RAG_GENERATION_PROFILE", "balanced")
+# Requests that do not name a profile switch to LOAD_SHED_PROFILE while at
+# least LOAD_SHED_QUEUE generations wait for an LLM slot (empty disables).
+LOAD_SHED_PROFILE = os.getenv("RAG_LOAD_SHED_PROFILE", "")
+LOAD_SHED_QUEUE = int(os.getenv("RAG_LOAD_SHED_QUEUE", "4"))
+PROFILE_STATS: Dict[str, Dict[str, float]] = {}
+
+
+def _profile_params(profile: Dict[str, Any], n_questions: int) -> Dict[str, Any]:
+    """Chat-completion parameters of a profile for a quiz of n_questions."""
+    params: Dict[str, Any] = {}
+    if profile.get("tokens_per_question"):
+        params["max_tokens"] = profile.get("reasoning_tokens", 0) + n_questions * profile["tokens_per_question"]
+    if profile.get("reasoning_effort"):
+        params["reasoning_effort"] = profile["reasoning_effort"]
+    if profile.get("stop"):
+        params["stop"] = profile["stop"]
+    return params
+
+
+def _profile_stats(profile: str) -> Dict[str, float]:
+    return PROFILE_STATS.setdefault(
+        profile, {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "truncated": 0, "shed": 0}
+    )
+
+
+def _record_generation(profile: str, seconds: float, usage: Dict[str, Any]) -> None:
+    stats = _profile_stats(profile)
+    stats["calls"] += 1
+    stats["seconds"] += seconds
+    stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+    stats["completion_tokens"] += usage.get("completion_tokens") or 0
+    stats["truncated"] += usage.get("finish_reason") == "length"
+
+
+# Priority classes for LLM admission; lower value is served first.
+PRIORITY_CLASSES = {"interactive": 0, "pregen": 1}
+
+
+# Pod-local on purpose: CACHE_DIR may be a volume shared by all pods, which
+# would turn a per-pod limit into one for the whole deployment.
+SLOTS_DIR = Path(os.getenv("RAG_SLOTS_DIR", tempfile.gettempdir())) / "rag-slots"
+
+
+class PodSlots:
+    """A fixed number of flock-held lock files shared by all worker processes
+    of a pod, so a concurrency limit holds per pod rather than per worker."""
+
+    def __init__(self, name: str, slots: int):
+        SLOTS_DIR.mkdir(parents=True, exist_ok=True)
+        self.paths = [SLOTS_DIR / f"{name}-{i}.lock" for i in range(max(1, slots))]
+
+    def try_acquire(self):
+        """An open, locked slot file, or None when every slot is held."""
+        for path in random.sample(self.paths, len(self.paths)):
+            fh = open(path, "a+")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fh.close()
+                continue
+            return fh
+        return None
+
+    @staticmethod
+    def release(fh) -> None:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+
+class GenerationScheduler:
+    """Admission control for one LLM endpoint: max_inflight calls per pod
+    (PodSlots) plus a bounded per-worker priority wait queue. Runs on the event
+    loop, so no locking; waiters poll for slots freed by other workers."""
+
+    POLL_SECONDS = 0.05
+
+    def __init__(self, name: str, max_inflight: int, max_queue: int, queue_timeout: float):
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.slots = PodSlots(name, self.max_inflight)
+        self.inflight = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_sum = 0.0
+        self.wait_count = 0
+        self.service_seconds_ewma: Optional[float] = None
+        self._waiters: list[list] = []
+        self._seq = itertools.count()
+        self._poller: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        per_call = self.service_seconds_ewma or 30.0
+        return max(1, math.ceil(per_call * (self.queue_depth + 1) / self.max_inflight))
+
+    def _reject(self, status_code: int, detail: str) -> HTTPException:
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    def _record_wait(self, seconds: float) -> None:
+        self.wait_seconds_sum += seconds
+        self.wait_count += 1
+
+    def saturated(self) -> bool:
+        """True while generations wait here or every pod slot is taken."""
+        if self._waiters:
+            return True
+        fh = self.slots.try_acquire()
+        if fh is None:
+            return True
+        self.slots.release(fh)
+        return False
+
+    async def acquire(self, priority: int):
+        if not self._waiters:
+            fh = self.slots.try_acquire()
+            if fh is not None:
+                self.inflight += 1
+                self._record_wait(0.0)
+                return fh
+        if self.queue_depth >= self.max_queue:
+            self.rejected += 1
+            raise self._reject(429, "Generation queue is full, retry later")
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future]
+        heapq.heappush(self._waiters, entry)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll())
+        try:
+            fh = await asyncio.wait_for(future, timeout=_stage_timeout("llm queue", self.queue_timeout))
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up; pass it on.
+                self.release(future.result())
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise self._reject(503, "Timed out waiting for a generation slot")
+            raise
+        self._record_wait(time.monotonic() - start)
+        return fh
+
+    def _hand_over(self, fh) -> bool:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(fh)
+                return True
+        return False
+
+    async def _poll(self) -> None:
+        # Slots freed by other workers are only seen by trying them.
+        while self._waiters:
+            fh = self.slots.try_acquire()
+            if fh is None:
+                await asyncio.sleep(self.POLL_SECONDS)
+            elif self._hand_over(fh):
+                self.inflight += 1
+            else:
+                self.slots.release(fh)
+
+    def release(self, fh) -> None:
+        if not self._hand_over(fh):
+            # Hand the slot straight to the next waiter, or free it for the pod.
+            self.inflight -= 1
+            self.slots.release(fh)
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        fh = await self.acquire(priority)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            if self.service_seconds_ewma is None:
+                self.service_seconds_ewma = elapsed
+            else:
+                self.service_seconds_ewma = 0.8 * self.service_seconds_ewma + 0.2 * elapsed
+            self.release(fh)
+
+
+_SCHEDULERS: dict[str, GenerationScheduler] = {}
+
+
+def _scheduler_for(endpoints: list[str]) -> GenerationScheduler:
+    """One scheduler per LLM endpoint pool; capacity scales with its replicas."""
+    key = ",".join(_normalize_llm_endpoint(e) for e in endpoints)
+    scheduler = _SCHEDULERS.get(key)
+    if scheduler is None:
+        scheduler = GenerationScheduler(
+            name=f"llm-{_sha256_bytes(key.encode('utf-8'))[:16]}",
+            max_inflight=int(os.getenv("RAG_LLM_MAX_INFLIGHT", "4")) * len(endpoints),
+            max_queue=int(os.getenv("RAG_LLM_MAX_QUEUE", "32")),
+            queue_timeout=float(os.getenv("RAG_LLM_QUEUE_TIMEOUT", "60")),
+        )
+        _SCHEDULERS[key] = scheduler
+    return scheduler
+
+
+def _context_sort_key(doc) -> tuple:
+    meta = doc.metadata or {}
+    return (str(meta.get("source", "")), int(meta.get("page", 0) or 0), doc.page_content)
+
+
+def _retrieve_context(
+    pdf_bytes_list: list[bytes],
+    embeddings: NIMEmbedding,
+    chunk_size: int,
+    chunk_overlap: int,
+    query: str,
+    top_k: int,
+    pin_context: bool = False,
+    dedup_threshold: float = 0.0,
+    retrieval: str = "vector",
+    context_tokens: int = 0,
+) -> str:
+    doc_hashes = [_sha256_bytes(b) for b in pdf_bytes_list]
+    index_key = _index_key(doc_hashes, chunk_size, chunk_overlap, dedup_threshold, embeddings.model)
+    pin_key = None
+    if pin_context:
+        pin_key = f"{index_key}:{top_k}:{retrieval}:{context_tokens}"
+        pinned = PINNED_CONTEXTS.get_json(pin_key)
+        if pinned is not None:
+            return pinned
+
+    persist_root = Path(os.getenv("RAG_CHROMA_DIR", "/data/chroma"))
+    vectorstore = _build_vectorstore(
+        pdf_bytes_list, embeddings, persist_root, chunk_size, chunk_overlap, dedup_threshold
+    )
+    _check_deadline("retrieval")
+    lexical = _lexical_index(persist_root / index_key, vectorstore)
+    docs = _search_chunks(vectorstore, lexical, query, top_k, retrieval)
+    if context_tokens and docs:
+        # Chunks are in rank order here, so the budget drops the weakest ones.
+        total, kept = 0, 0
+        for tokens in _token_counter()([d.page_content for d in docs]):
+            total += tokens
+            if total > context_tokens and kept:
+                break
+            kept += 1
+        docs = docs[:kept]
+    # Document order rather than score order, so overlapping selections share a prefix.
+    docs.sort(key=_context_sort_key)
+    context = "\n\n".join(d.page_content for d in docs)
+    if pin_key is not None:
+        PINNED_CONTEXTS.set_json(pin_key, context)
+    return context
+
+
+def _rag_settings(rag: Dict[str, Any]) -> Dict[str, Any]:
+    """Resolve a `rag` payload against env defaults and validate it."""
+    embedding = rag.get("embedding", {}) or {}
+    llm = rag.get("llm", {}) or {}
+
+    embedding_endpoint = embedding.get("endpoint") or os.getenv("RAG_EMBEDDING_ENDPOINT", "")
+    llm_endpoint = llm.get("endpoint") or os.getenv("RAG_LLM_ENDPOINT", "")
+    pin_context = rag.get("pin_context")
+    if pin_context is None:
+        pin_context = os.getenv("RAG_PIN_CONTEXT", "false").lower() == "true"
+
+    settings = {
+        "embedding_endpoints": _endpoint_list(embedding.get("endpoints"), "RAG_EMBEDDING_ENDPOINTS", embedding_endpoint),
+        "embedding_token": embedding.get("token") or os.getenv("RAG_EMBEDDING_TOKEN", ""),
+        "embedding_model": embedding.get("model") or os.getenv("RAG_EMBEDDING_MODEL", ""),
+        "llm_endpoints": _endpoint_list(llm.get("endpoints"), "RAG_LLM_ENDPOINTS", llm_endpoint),
+        "llm_token": llm.get("token") or os.getenv("RAG_LLM_TOKEN", ""),
+        "llm_model": llm.get("model") or os.getenv("RAG_LLM_MODEL", "default"),
+        "chunk_size": int(rag.get("chunk_size") or os.getenv("RAG_CHUNK_SIZE", "512")),
+        "chunk_overlap": int(rag.get("chunk_overlap") or os.getenv("RAG_CHUNK_OVERLAP", "64")),
+        # An explicit top_k overrides the generation profile's.
+        "top_k": int(rag["top_k"]) if rag.get("top_k") else None,
+        "dedup_threshold": float(
+            rag["dedup_threshold"]
+            if rag.get("dedup_threshold") is not None
+            else os.getenv("RAG_DEDUP_THRESHOLD", "0.85")
+        ),
+        "pin_context": bool(pin_context),
+        "priority": rag.get("priority") or "interactive",
+        "retrieval": (rag.get("retrieval") or os.getenv("RAG_RETRIEVAL", "vector")).lower(),
+        "profile": rag.get("profile") or None,
+        "question_dedup_threshold": float(
+            rag["question_dedup_threshold"]
+            if rag.get("question_dedup_threshold") is not None
+            else QUESTION_DEDUP_THRESHOLD
+        ),
+    }
+
+    if settings["retrieval"] not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"retrieval must be one of {list(RETRIEVAL_MODES)}")
+    if settings["profile"] is not None and settings["profile"] not in GENERATION_PROFILES:
+        raise HTTPException(status_code=400, detail=f"profile must be one of {sorted(GENERATION_PROFILES)}")
+    if settings["priority"] not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {sorted(PRIORITY_CLASSES)}")
+    if not settings["embedding_endpoints"] or not settings["embedding_model"]:
+        raise HTTPException(status_code=400, detail="embedding.endpoint and embedding.model are required")
+    if not settings["llm_endpoints"]:
+        raise HTTPException(status_code=400, detail="llm.endpoint is required")
+    return settings
+
+
+def _embeddings_for(settings: Dict[str, Any]) -> NIMEmbedding:
+    # Token-sized chunks already fit the model; character truncation would only
+    # cut off their tails. Free-form queries are still truncated.
+    max_chars = 0 if SPLITTER == "token" else 2000
+    return NIMEmbedding(
+        settings["embedding_endpoints"], settings["embedding_token"], settings["embedding_model"], max_chars=max_chars
+    )
+
+
+async def _load_documents(rag: Dict[str, Any]) -> list[bytes]:
+    pdf_bytes_list = _load_pdfs_from_payload(rag.get("pdfs", []) or [])
+    if pdf_bytes_list:
+        return pdf_bytes_list
+    pdf_url = rag.get("pdf_url") or os.getenv("RAG_PDF_URL", "")
+    pdf_path = rag.get("pdf_path") or os.getenv("RAG_PDF_PATH", "")
+    return [await _in_thread(_load_pdf_bytes, pdf_url, pdf_path)]
+
+
+PDF_PRELOAD = os.getenv("RAG_PDF_PRELOAD", "true").lower() == "true"
+# Readiness waits at most this long for the preload, which then continues in
+# the background (0 never holds readiness for it).
+PDF_PRELOAD_READY_TIMEOUT = float(os.getenv("RAG_PDF_PRELOAD_READY_TIMEOUT", "30"))
+_PRELOAD_READY_AT = 0.0
+_PRELOAD_STATE: dict[str, Any] = {
+    "done": not (PDF_PRELOAD and (os.getenv("RAG_PDF_URL") or os.getenv("RAG_PDF_PATH"))),
+    "error": "",
+    "seconds": None,
+}
+
+
+def _preload_default_document() -> None:
+    """Download, parse, embed and index the deployment's default document
+    (RAG_PDF_URL / RAG_PDF_PATH) so the first request for it finds all caches
+    warm. Workers share the work through the download and index locks."""
+    start = time.perf_counter()
+    try:
+        settings = _rag_settings({})
+        pdf_bytes = _load_pdf_bytes(os.getenv("RAG_PDF_URL", ""), os.getenv("RAG_PDF_PATH", ""))
+        persist_root = Path(os.getenv("RAG_CHROMA_DIR", "/data/chroma"))
+        embeddings = _embeddings_for(settings)
+        vectorstore = _build_vectorstore(
+            [pdf_bytes],
+            embeddings,
+            persist_root,
+            settings["chunk_size"],
+            settings["chunk_overlap"],
+            settings["dedup_threshold"],
+        )
+        index_key = _index_key(
+            [_sha256_bytes(pdf_bytes)],
+            settings["chunk_size"],
+            settings["chunk_overlap"],
+            settings["dedup_threshold"],
+            embeddings.model,
+        )
+        _lexical_index(persist_root / index_key, vectorstore)
+    except Exception as e:
+        _PRELOAD_STATE["error"] = f"{type(e).__name__}: {getattr(e, 'detail', e)}"
+        logger.warning("Default document preload failed: %s", _PRELOAD_STATE["error"])
+    else:
+        _PRELOAD_STATE["seconds"] = round(time.perf_counter() - start, 4)
+    _PRELOAD_STATE["done"] = True
+
+
+def _validate_quiz(content: str, n_questions: int) -> str:
+    match = re.search(r"\[[\s\S]*\]", content or "")
+    if not match:
+        raise HTTPException(status_code=500, detail="LLM did not return a JSON array")
+
+    json_text = match.group(0)
+    try:
+        parsed = json.loads(json_text)
+        if len(parsed) != n_questions:
+            raise ValueError("Wrong number of questions")
+        for q in parsed:
+            if set(q.keys()) != {"id", "question", "options", "correctIndex"}:
+                raise ValueError("Invalid question keys")
+            if len(q["options"]) != 4:
+                raise ValueError("Each question must have 4 options")
+            if q["correctIndex"] not in [0, 1, 2, 3]:
+                raise ValueError("correctIndex must be 0-3")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return json_text
+
+
+# ---------------------------
+# Question diversity: drop paraphrased duplicates within a quiz and against the
+# questions recently served for the same documents, and regenerate only those.
+# ---------------------------
+QUESTION_DEDUP_THRESHOLD = float(os.getenv("RAG_QUESTION_DEDUP_THRESHOLD", "0.92"))
+QUESTION_HISTORY_SIZE = int(os.getenv("RAG_QUESTION_HISTORY", "200"))
+QUESTION_REPLACEMENT_ROUNDS = 2
+QUESTION_HISTORY = SharedCache(CACHE_DIR / "banks.sqlite", "question_history")
+QUESTION_DEDUP_STATS = {"dropped": 0, "replacement_calls": 0}
+
+AVOID_SUFFIX = """Do not repeat or paraphrase any of these questions:
+{questions}
+"""
+
+
+def _question_history(key: str) -> list[str]:
+    return QUESTION_HISTORY.get_json(key) or []
+
+
+def _record_served(key: str, questions: list[dict]) -> None:
+    if QUESTION_HISTORY_SIZE <= 0:
+        return
+    with _process_lock(f"history-{key[:32]}"):
+        history = _question_history(key) + [q["question"] for q in questions]
+        QUESTION_HISTORY.set_json(key, history[-QUESTION_HISTORY_SIZE:])
+
+
+def _split_duplicates(
+    embeddings: NIMEmbedding, questions: list[dict], reference: list[str], threshold: float
+) -> tuple[list[dict], list[dict]]:
+    """Split questions into (kept, dropped). A question is dropped when its cosine
+    similarity to a reference question or to an earlier kept one reaches threshold;
+    all of them are embedded in one batch and compared in one matrix product."""
+    if not questions:
+        return [], []
+    matrix = _normalize_rows(embeddings.embed_queries_array(reference + [q["question"] for q in questions]))
+    offset = len(reference)
+    similarity = matrix[offset:] @ matrix.T
+    allowed = np.zeros(len(matrix), dtype=bool)
+    allowed[:offset] = True
+    kept, dropped = [], []
+    for i, q in enumerate(questions):
+        if similarity[i, allowed].max(initial=-1.0) >= threshold:
+            dropped.append(q)
+        else:
+            kept.append(q)
+            allowed[offset + i] = True
+    QUESTION_DEDUP_STATS["dropped"] += len(dropped)
+    return kept, dropped
+
+
+async def _diversify(
+    questions: list[dict],
+    history: list[str],
+    threshold: float,
+    embeddings: NIMEmbedding,
+    regenerate,
+) -> list[dict]:
+    """Replace near-duplicate questions with freshly generated ones, keeping the count.
+
+    Dedup is best effort: if embedding or a replacement call fails, the quiz
+    is served as generated.
+    """
+    try:
+        kept, dropped = await _in_thread(_split_duplicates, embeddings, questions, history, threshold)
+        for _ in range(QUESTION_REPLACEMENT_ROUNDS):
+            if not dropped:
+                break
+            QUESTION_DEDUP_STATS["replacement_calls"] += 1
+            avoid = "\n".join(f"- {q['question']}" for q in kept + dropped)
+            replacements = await regenerate(len(dropped), AVOID_SUFFIX.format(questions=avoid))
+            more, dropped = await _in_thread(
+                _split_duplicates, embeddings, replacements, history + [q["question"] for q in kept], threshold
+            )
+            kept += more
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.warning("Question dedup skipped: %s", e)
+        return questions
+    # Still duplicated after the last round: serve them rather than a short quiz.
+    return kept + dropped
+
+
+async def _generate_quiz(
+    settings: Dict[str, Any],
+    pdf_bytes_list: list[bytes],
+    user_msg: str,
+    system_msg: str,
+    n_questions: int,
+) -> str:
+    """Retrieve context, call the LLM under admission control and return validated quiz JSON."""
+    llm_endpoints = settings["llm_endpoints"]
+    profile_name = settings["profile"] or GENERATION_PROFILE
+    shed = (
+        settings["profile"] is None
+        and LOAD_SHED_PROFILE in GENERATION_PROFILES
+        and settings["priority"] == "interactive"
+        and _scheduler_for(llm_endpoints).queue_depth >= LOAD_SHED_QUEUE
+    )
+    if shed:
+        profile_name = LOAD_SHED_PROFILE
+        _profile_stats(profile_name)["shed"] += 1
+    profile = GENERATION_PROFILES[profile_name]
+
+    embeddings = _embeddings_for(settings)
+    context = await _in_thread(
+        _retrieve_context,
+        pdf_bytes_list,
+        embeddings,
+        settings["chunk_size"],
+        settings["chunk_overlap"],
+        user_msg or "quiz questions",
+        settings["top_k"] or profile["top_k"],
+        settings["pin_context"],
+        settings["dedup_threshold"],
+        settings["retrieval"],
+        profile["context_tokens"],
+    )
+
+    async def generate(n: int, suffix: str = "") -> str:
+        # The avoid-list goes after the shared prompt so the prefix stays cacheable.
+        prompt = _build_prompt(context, n) + suffix
+        params = _profile_params(profile, n)
+        async with _scheduler_for(llm_endpoints).slot(PRIORITY_CLASSES[settings["priority"]]):
+            started = time.monotonic()
+            content, usage = await _call_llm(
+                llm_endpoints, settings["llm_token"], settings["llm_model"], system_msg, prompt, params
+            )
+        _record_generation(profile_name, time.monotonic() - started, usage)
+        try:
+            return _validate_quiz(content, n)
+        except HTTPException as e:
+            if usage.get("finish_reason") != "length":
+                raise
+            limit = params.get("max_tokens", "the endpoint default")
+            raise HTTPException(
+                status_code=502,
+                detail=f"LLM output truncated at max_tokens={limit} (profile {profile_name!r}): {e.detail}",
+            )
+
+    json_text = await generate(n_questions)
+    threshold = settings["question_dedup_threshold"]
+    if threshold <= 0:
+        return json_text
+
+    async def regenerate(n: int, suffix: str) -> list[dict]:
+        return json.loads(await generate(n, suffix))
+
+    history_key = _document_key(pdf_bytes_list)
+    history = await run_in_threadpool(_question_history, history_key)
+    if settings["priority"] == "pregen":
+        # Banked questions are served without another generation, so new ones
+        # must also differ from those already waiting in the bank.
+        history = history + await run_in_threadpool(_bank_questions, _bank_key(settings, pdf_bytes_list))
+    questions = await _diversify(json.loads(json_text), history, threshold, embeddings, regenerate)
+    questions = [{**q, "id": i + 1} for i, q in enumerate(questions)]
+    if settings["priority"] != "pregen":
+        # Banked questions are recorded when they are served, not when generated.
+        await run_in_threadpool(_record_served, history_key, questions)
+    return json.dumps(questions)
+
+
+# ---------------------------
+# Question banks (background pre-generation)
+# ---------------------------
+PREGEN_ENABLED = os.getenv("RAG_PREGEN_ENABLED", "false").lower() == "true"
+PREGEN_BANK_SIZE = int(os.getenv("RAG_PREGEN_BANK_SIZE", "50"))
+PREGEN_BATCH = int(os.getenv("RAG_PREGEN_BATCH", "10"))
+PREGEN_MAX_FAILURES = 3
+QUESTION_BANKS = SharedCache(CACHE_DIR / "banks.sqlite", "banks")
+_PREGEN_QUEUE: Optional[asyncio.Queue] = None
+_PREGEN_PENDING: set[str] = set()
+
+# Words that do not narrow a request down to a topic; a prompt made only of
+# these (and numbers) can be served from the document's question bank.
+_GENERIC_PROMPT_WORDS = {
+    "generate", "create", "make", "write", "give", "me", "a", "an", "the", "of", "exactly",
+    "multiple", "choice", "multiple-choice", "mcq", "question", "questions", "quiz", "please",
+}
+
+
+def _is_generic_prompt(user_msg: str) -> bool:
+    words = re.findall(r"[a-z][a-z-]*", (user_msg or "").lower())
+    return all(w in _GENERIC_PROMPT_WORDS for w in words)
+
+
+def _bank_key(settings: Dict[str, Any], pdf_bytes_list: list[bytes]) -> str:
+    index_key = _index_key(
+        [_sha256_bytes(b) for b in pdf_bytes_list],
+        settings["chunk_size"],
+        settings["chunk_overlap"],
+        settings["dedup_threshold"],
+        settings["embedding_model"],
+    )
+    return f"{index_key}:{settings['llm_model']}"
+
+
+def _bank_size(key: str) -> int:
+    return len(QUESTION_BANKS.get_json(key) or [])
+
+
+def _bank_questions(key: str) -> list[str]:
+    return [q["question"] for q in QUESTION_BANKS.get_json(key) or []]
+
+
+def _take_from_bank(
+    key: str, n: int, history_key: str, embeddings: NIMEmbedding, threshold: float
+) -> Optional[list[dict]]:
+    """n banked questions, or None when the bank has too few. Banked questions
+    that became near-duplicates of questions served since they were generated
+    are dropped from the bank first (best effort, like _diversify)."""
+    with _process_lock(f"bank-{key[:32]}"):
+        bank = QUESTION_BANKS.get_json(key) or []
+        if len(bank) < n:
+            return None
+        if threshold > 0:
+            try:
+                fresh, stale = _split_duplicates(embeddings, bank, _question_history(history_key), threshold)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                logger.warning("Question bank dedup skipped: %s", e)
+            else:
+                bank = fresh
+                if len(bank) < n:
+                    if stale:
+                        QUESTION_BANKS.set_json(key, bank)
+                    return None
+        QUESTION_BANKS.set_json(key, bank[n:])
+    return [{**q, "id": i + 1} for i, q in enumerate(bank[:n])]
+
+
+def _add_to_bank(key: str, questions: list[dict]) -> None:
+    with _process_lock(f"bank-{key[:32]}"):
+        bank = QUESTION_BANKS.get_json(key) or []
+        seen = {q["question"].strip().lower() for q in bank}
+        for q in questions:
+            if q["question"].strip().lower() not in seen:
+                seen.add(q["question"].strip().lower())
+                bank.append(q)
+        QUESTION_BANKS.set_json(key, bank)
+
+
+def _schedule_pregen(key: str, settings: Dict[str, Any], pdf_bytes_list: list[bytes], system_msg: str) -> None:
+    if _PREGEN_QUEUE is None or key in _PREGEN_PENDING:
+        return
+    _PREGEN_PENDING.add(key)
+    # A pinned context would give every batch the same retrieved chunks.
+    settings = {**settings, "priority": "pregen", "pin_context": False}
+    _PREGEN_QUEUE.put_nowait((key, settings, pdf_bytes_list, system_msg))
+
+
+def _pregen_queries(settings: Dict[str, Any], pdf_bytes_list: list[bytes]) -> list[str]:
+    """The document's chunk texts, used as retrieval queries so that successive
+    pre-generation batches draw on different parts of the document."""
+    index_key = _index_key(
+        [_sha256_bytes(b) for b in pdf_bytes_list],
+        settings["chunk_size"],
+        settings["chunk_overlap"],
+        settings["dedup_threshold"],
+        settings["embedding_model"],
+    )
+    persist_dir = Path(os.getenv("RAG_CHROMA_DIR", "/data/chroma")) / index_key
+    index = _BM25_INDEXES.get(str(persist_dir)) or BM25Index.load(persist_dir)
+    return [d["text"] for d in index.docs] if index is not None and index.docs else ["quiz questions"]
+
+
+async def _pregen_worker() -> None:
+    """Fill question banks up to PREGEN_BANK_SIZE using only idle LLM capacity."""
+    while True:
+        key, settings, pdf_bytes_list, system_msg = await _PREGEN_QUEUE.get()
+        try:
+            # One filler per bank across all worker processes.
+            with _process_lock(f"pregen-{key[:32]}", blocking=False) as acquired:
+                if not acquired:
+                    continue
+                scheduler = _scheduler_for(settings["llm_endpoints"])
+                queries = await run_in_threadpool(_pregen_queries, settings, pdf_bytes_list)
+                failures = 0
+                while failures < PREGEN_MAX_FAILURES:
+                    if await run_in_threadpool(_bank_size, key) >= PREGEN_BANK_SIZE:
+                        break
+                    if scheduler.saturated():
+                        await asyncio.sleep(1.0)
+                        continue
+                    try:
+                        json_text = await _generate_quiz(
+                            settings, pdf_bytes_list, random.choice(queries), system_msg, PREGEN_BATCH
+                        )
+                    except Exception as e:
+                        failures += 1
+                        logger.warning("Question bank pre-generation failed: %s", e)
+                        continue
+                    await run_in_threadpool(_add_to_bank, key, json.loads(json_text))
+        finally:
+            _PREGEN_PENDING.discard(key)
+
+
+@app.post("/chat/completions")
+async def chat_completions(payload: Dict[str, Any], request: Request):
+    rag = payload.get("rag", {}) or {}
+    deadline = _request_deadline(request, rag)
+    return await _with_deadline(request, deadline, _chat_completion(payload))
+
+
+async def _chat_completion(payload: Dict[str, Any]):
+    rag = payload.get("rag", {}) or {}
+    messages = payload.get("messages", [])
+
+    user_msg = next((m.get("content") for m in messages if m.get("role") == "user"), "") or ""
+    system_msg = next((m.get("content") for m in messages if m.get("role") == "system"), "") or ""
+    system_msg = system_msg or DEFAULT_SYSTEM_PROMPT
+
+    n_questions = _extract_num_questions(user_msg, default_n=5)
+    settings = _rag_settings(rag)
+    pdf_bytes_list = await _load_documents(rag)
+    headers = {DOCUMENT_KEY_HEADER: _document_key(pdf_bytes_list)}
+
+    if PREGEN_ENABLED:
+        bank_key = _bank_key(settings, pdf_bytes_list)
+        if rag.get("use_bank", True) and _is_generic_prompt(user_msg):
+            banked = await run_in_threadpool(
+                _take_from_bank,
+                bank_key,
+                n_questions,
+                headers[DOCUMENT_KEY_HEADER],
+                _embeddings_for(settings),
+                settings["question_dedup_threshold"],
+            )
+            if banked is not None:
+                await run_in_threadpool(_record_served, headers[DOCUMENT_KEY_HEADER], banked)
+                _schedule_pregen(bank_key, settings, pdf_bytes_list, system_msg)
+                return JSONResponse({"choices": [{"message": {"content": json.dumps(banked)}}]}, headers=headers)
+
+    json_text = await _generate_quiz(settings, pdf_bytes_list, user_msg, system_msg, n_questions)
+    if PREGEN_ENABLED:
+        # The document is ingested now; top up its bank in the background.
+        _schedule_pregen(bank_key, settings, pdf_bytes_list, system_msg)
+    return JSONResponse({"choices": [{"message": {"content": json_text}}]}, headers=headers)
+
+
+# ---------------------------
+# Batch generation
+# ---------------------------
+# Manifests and job results are dropped this long after their last use.
+BATCH_TTL_SECONDS = float(os.getenv("RAG_BATCH_TTL_HOURS", "168")) * 3600
+BATCHES = SharedCache(CACHE_DIR / "batches.sqlite", "batches", ttl=BATCH_TTL_SECONDS)
+BATCH_MAX_RETRIES = 3
+_BATCH_TASKS: set[asyncio.Task] = set()
+
+
+def _batch_manifest(batch_id: str) -> Optional[Dict[str, Any]]:
+    return BATCHES.get_json(f"{batch_id}:manifest")
+
+
+def _batch_lock(batch_id: str, blocking: bool = False):
+    """Held by the worker running the batch; released when the run ends or
+    the process dies."""
+    return _process_lock(f"batch-{_sha256_bytes(batch_id.encode('utf-8'))[:32]}", blocking=blocking)
+
+
+def _batch_running(batch_id: str) -> bool:
+    with _batch_lock(batch_id) as acquired:
+        return not acquired
+
+
+def _batch_entry(batch_id: str, position: int, job_id: str) -> Dict[str, Any]:
+    # Batches logged before entries were stored per position only have the
+    # latest result of each job.
+    return (
+        BATCHES.get_json(f"{batch_id}:log:{position}")
+        or BATCHES.get_json(f"{batch_id}:job:{job_id}")
+        or {"job_id": job_id}
+    )
+
+
+async def _run_batch(batch_id: str, payload: Dict[str, Any], pending: list[Dict[str, Any]]) -> None:
+    rag = payload.get("rag", {}) or {}
+    settings = _rag_settings(rag)
+    documents = payload.get("documents", {}) or {}
+
+    # Each document is loaded once and each distinct document set is ingested
+    # once, no matter how many jobs reference it.
+    loaded: dict[str, asyncio.Task] = {}
+    ingested: dict[tuple[str, ...], asyncio.Task] = {}
+
+    async def load(doc_id: str) -> bytes:
+        spec = documents.get(doc_id)
+        if spec is None:
+            raise HTTPException(status_code=400, detail=f"Unknown document '{doc_id}'")
+        blobs = _load_pdfs_from_payload([spec])
+        if blobs:
+            return blobs[0]
+        return await run_in_threadpool(_load_pdf_bytes, spec.get("pdf_url"), spec.get("pdf_path"))
+
+    async def ingest(doc_ids: tuple[str, ...]) -> list[bytes]:
+        if not doc_ids:
+            # No documents in the batch: fall back to rag.pdf_url / RAG_PDF_URL.
+            pdf_bytes_list = await _load_documents(rag)
+        else:
+            for doc_id in doc_ids:
+                if doc_id not in loaded:
+                    loaded[doc_id] = asyncio.ensure_future(load(doc_id))
+            pdf_bytes_list = [await loaded[doc_id] for doc_id in doc_ids]
+        await run_in_threadpool(
+            _build_vectorstore,
+            pdf_bytes_list,
+            _embeddings_for(settings),
+            Path(os.getenv("RAG_CHROMA_DIR", "/data/chroma")),
+            settings["chunk_size"],
+            settings["chunk_overlap"],
+            settings["dedup_threshold"],
+        )
+        return pdf_bytes_list
+
+    # Stay within the LLM admission limit instead of flooding its wait queue.
+    limit = asyncio.Semaphore(_scheduler_for(settings["llm_endpoints"]).max_inflight)
+
+    async def run_job(job: Dict[str, Any]) -> None:
+        doc_ids = tuple(job.get("documents") or sorted(documents))
+        user_msg = job.get("prompt") or ""
+        n_questions = int(job.get("n") or _extract_num_questions(user_msg, default_n=5))
+        system_msg = job.get("system") or DEFAULT_SYSTEM_PROMPT
+        result: Dict[str, Any] = {"job_id": job["id"]}
+        try:
+            if doc_ids not in ingested:
+                ingested[doc_ids] = asyncio.ensure_future(ingest(doc_ids))
+            pdf_bytes_list = await ingested[doc_ids]
+            async with limit:
+                for attempt in range(BATCH_MAX_RETRIES + 1):
+                    try:
+                        content = await _generate_quiz(settings, pdf_bytes_list, user_msg, system_msg, n_questions)
+                        break
+                    except HTTPException as e:
+                        retry_after = (e.headers or {}).get("Retry-After")
+                        if retry_after is None or attempt == BATCH_MAX_RETRIES:
+                            raise
+                        await asyncio.sleep(float(retry_after))
+            result.update(status="ok", content=content)
+        except HTTPException as e:
+            result.update(status="error", error=str(e.detail))
+        except Exception as e:
+            result.update(status="error", error=f"{type(e).__name__}: {e}")
+        # "completed" is an append-only log: a job run again gets a new entry,
+        # so positions already counted by streaming clients never shift.
+        manifest = _batch_manifest(batch_id) or {}
+        completed = manifest.setdefault("completed", [])
+        BATCHES.set_json(f"{batch_id}:log:{len(completed)}", result)
+        BATCHES.set_json(f"{batch_id}:job:{job['id']}", result)
+        completed.append(job["id"])
+        BATCHES.set_json(f"{batch_id}:manifest", manifest)
+
+    await asyncio.gather(*(run_job(job) for job in pending))
+
+
+@app.post("/batch")
+async def create_batch(payload: Dict[str, Any]):
+    """Start (or resume) generation of many quizzes. Jobs are
+    {"id", "documents": [doc ids], "n", "prompt", "system"}; documents map
+    ids to {"content_b64"} or {"pdf_url"}. Resubmitting the same batch_id
+    re-runs only the jobs without a successful result, appending their new
+    results; while that batch is still running, on any worker of the pod,
+    the resubmit gets 409."""
+    jobs = payload.get("jobs", []) or []
+    if not jobs:
+        raise HTTPException(status_code=400, detail="jobs must not be empty")
+    _rag_settings(payload.get("rag", {}) or {})
+
+    batch_id = payload.get("batch_id") or _sha256_bytes(os.urandom(16))[:16]
+    for i, job in enumerate(jobs):
+        job["id"] = str(job.get("id") or f"job-{i + 1}")
+    job_ids = [job["id"] for job in jobs]
+    if len(set(job_ids)) != len(job_ids):
+        raise HTTPException(status_code=400, detail="job ids must be unique")
+
+    # Held until the run finishes, so a resubmit cannot run the same jobs twice.
+    running = ExitStack()
+    if not running.enter_context(_batch_lock(batch_id)):
+        running.close()
+        raise HTTPException(status_code=409, detail=f"Batch {batch_id} is still running")
+    try:
+        manifest = _batch_manifest(batch_id) or {"completed": []}
+        done = {
+            job_id
+            for job_id in manifest["completed"]
+            if (BATCHES.get_json(f"{batch_id}:job:{job_id}") or {}).get("status") == "ok"
+        }
+        pending = [job for job in jobs if job["id"] not in done]
+        manifest["jobs"] = job_ids
+        BATCHES.set_json(f"{batch_id}:manifest", manifest)
+        task = asyncio.create_task(_run_batch(batch_id, payload, pending))
+    except BaseException:
+        running.close()
+        raise
+    _BATCH_TASKS.add(task)
+    task.add_done_callback(_BATCH_TASKS.discard)
+    task.add_done_callback(lambda _: running.close())
+    return {"batch_id": batch_id, "jobs": job_ids, "pending": [job["id"] for job in pending]}
+
+
+@app.get("/batch/{batch_id}")
+def batch_status(batch_id: str):
+    manifest = _batch_manifest(batch_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    # Latest result per job, in order of first completion.
+    latest = dict.fromkeys(manifest["completed"])
+    results = [BATCHES.get_json(f"{batch_id}:job:{job_id}") or {"job_id": job_id} for job_id in latest]
+    return {"batch_id": batch_id, "jobs": manifest["jobs"], "completed": len(results), "results": results}
+
+
+@app.get("/batch/{batch_id}/stream")
+async def batch_stream(batch_id: str, cursor: int = 0):
+    """NDJSON of job results in completion order, including re-runs of a
+    resubmitted batch. A client that lost the connection resumes with
+    cursor = number of lines already received. Ends once the batch is no
+    longer running (finished, or its worker died) and all results are sent."""
+    if _batch_manifest(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+
+    async def lines():
+        position = cursor
+        while True:
+            # Probed before reading, so results logged just before the run
+            # ended are still sent.
+            running = _batch_running(batch_id)
+            completed = (_batch_manifest(batch_id) or {}).get("completed", [])
+            for job_id in completed[position:]:
+                result = _batch_entry(batch_id, position, job_id)
+                position += 1
+                yield json.dumps({**result, "cursor": position}) + "\n"
+            if not running:
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/healthz")
+def healthz():
+    return {"ok": True}
+
+
+@app.get("/readyz")
+def readyz():
+    # A failed or slow preload does not hold readiness: requests still work, only colder.
+    preloaded = _PRELOAD_STATE["done"] or time.monotonic() >= _PRELOAD_READY_AT
+    ready = _WARM_STATE["ready"] and preloaded
+    body = {
+        "ready": ready,
+        "warmup_seconds": _WARM_STATE["seconds"],
+        "error": _WARM_STATE["error"],
+        "imports": IMPORT_TIMINGS,
+        "preload": _PRELOAD_STATE,
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+
+# Each worker process publishes its samples to a pod-local directory so that a
+# scrape, served by whichever worker accepts it, reports the whole pod.
+METRICS_DIR = Path(os.getenv("RAG_METRICS_DIR", tempfile.gettempdir())) / "rag-metrics"
+METRICS_PUBLISH_INTERVAL = 2.0
+# Combined across workers by maximum; everything else is summed.
+_MAX_METRICS = {"rag_endpoint_latency_seconds", "rag_endpoint_circuit_open"}
+_METRIC_TYPES = {
+    "rag_llm_inflight": "gauge",
+    "rag_llm_queue_depth": "gauge",
+    "rag_llm_queue_wait_seconds": "summary",
+    "rag_llm_rejected_total": "counter",
+    "rag_llm_queue_timeouts_total": "counter",
+    "rag_pregen_pending": "gauge",
+    "rag_question_duplicates_total": "counter",
+    "rag_question_replacement_calls_total": "counter",
+    "rag_retrieval_total": "counter",
+    "rag_chunks_dropped_total": "counter",
+    "rag_pdf_downloads_total": "counter",
+    "rag_generation_seconds": "summary",
+    "rag_generation_prompt_tokens_total": "counter",
+    "rag_generation_completion_tokens_total": "counter",
+    "rag_generation_truncated_total": "counter",
+    "rag_generation_load_shed_total": "counter",
+    "rag_endpoint_outstanding": "gauge",
+    "rag_endpoint_latency_seconds": "gauge",
+    "rag_endpoint_circuit_open": "gauge",
+}
+
+
+def _local_metrics() -> Dict[str, float]:
+    samples: Dict[str, float] = {}
+    for endpoint, scheduler in _SCHEDULERS.items():
+        label = f'{{endpoint="{endpoint}"}}'
+        samples[f"rag_llm_inflight{label}"] = scheduler.inflight
+        samples[f"rag_llm_queue_depth{label}"] = scheduler.queue_depth
+        samples[f"rag_llm_queue_wait_seconds_sum{label}"] = round(scheduler.wait_seconds_sum, 6)
+        samples[f"rag_llm_queue_wait_seconds_count{label}"] = scheduler.wait_count
+        samples[f"rag_llm_rejected_total{label}"] = scheduler.rejected
+        samples[f"rag_llm_queue_timeouts_total{label}"] = scheduler.timed_out
+    samples["rag_pregen_pending"] = len(_PREGEN_PENDING)
+    samples["rag_question_duplicates_total"] = QUESTION_DEDUP_STATS["dropped"]
+    samples["rag_question_replacement_calls_total"] = QUESTION_DEDUP_STATS["replacement_calls"]
+    samples["rag_chunks_dropped_total"] = INGEST_STATS["dropped_chunks"]
+    for mode, count in RETRIEVAL_STATS.items():
+        samples[f'rag_retrieval_total{{mode="{mode}"}}'] = count
+    for result, count in DOWNLOAD_STATS.items():
+        samples[f'rag_pdf_downloads_total{{result="{result}"}}'] = count
+    for profile, stats in PROFILE_STATS.items():
+        label = f'{{profile="{profile}"}}'
+        samples[f"rag_generation_seconds_sum{label}"] = round(stats["seconds"], 6)
+        samples[f"rag_generation_seconds_count{label}"] = stats["calls"]
+        samples[f"rag_generation_prompt_tokens_total{label}"] = stats["prompt_tokens"]
+        samples[f"rag_generation_completion_tokens_total{label}"] = stats["completion_tokens"]
+        samples[f"rag_generation_truncated_total{label}"] = stats["truncated"]
+        samples[f"rag_generation_load_shed_total{label}"] = stats["shed"]
+    now = time.monotonic()
+    for pool in list(_POOLS.values()):
+        for ep in pool.endpoints:
+            label = f'{{endpoint="{ep.url}"}}'
+            samples[f"rag_endpoint_outstanding{label}"] = ep.outstanding
+            samples[f"rag_endpoint_latency_seconds{label}"] = round(ep.latency_ewma or 0.0, 6)
+            samples[f"rag_endpoint_circuit_open{label}"] = int(ep.open_until > now)
+    return samples
+
+
+def _publish_metrics() -> None:
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = METRICS_DIR / f".{os.getpid()}.tmp"
+    tmp.write_text(json.dumps(_local_metrics()))
+    os.replace(tmp, METRICS_DIR / f"{os.getpid()}.json")
+    if DEBUG_TOKEN:
+        tmp.write_text(json.dumps(_local_requests()))
+        os.replace(tmp, METRICS_DIR / f"{os.getpid()}.requests")
+
+
+async def _metrics_publisher() -> None:
+    while True:
+        try:
+            _publish_metrics()
+        except OSError as e:
+            logger.warning("Publishing metrics failed: %s", e)
+        await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+
+
+def _worker_files(suffix: str) -> Iterator[Any]:
+    """Contents of the files published by live worker processes of this pod."""
+    for path in METRICS_DIR.glob(f"*.{suffix}"):
+        try:
+            os.kill(int(path.stem), 0)
+        except ProcessLookupError:
+            # A worker that exited (or was recycled by gunicorn).
+            path.unlink(missing_ok=True)
+            continue
+        except (ValueError, PermissionError):
+            pass
+        try:
+            yield json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+
+
+def _pod_metrics() -> Dict[str, float]:
+    """Samples of all live worker processes of this pod, combined."""
+    _publish_metrics()
+    combined: Dict[str, float] = {}
+    for samples in _worker_files("json"):
+        for key, value in samples.items():
+            if key not in combined:
+                combined[key] = value
+            elif key.split("{", 1)[0] in _MAX_METRICS:
+                combined[key] = max(combined[key], value)
+            else:
+                combined[key] += value
+    return combined
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of LLM admission state for the whole pod, for autoscaling."""
+    lines = [f"# TYPE {name} {kind}" for name, kind in _METRIC_TYPES.items()]
+    lines += [f"{key} {value}" for key, value in sorted(_pod_metrics().items())]
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+
+# ---------------------------
+# Debug endpoints: CPU profiles, allocation snapshots, per-request RSS and
+# in-flight requests. Registered only when RAG_DEBUG_TOKEN is set, and then
+# require it in the X-Debug-Token header; otherwise nothing is tracked.
+# ---------------------------
+DEBUG_TOKEN = os.getenv("RAG_DEBUG_TOKEN", "")
+DEBUG_MAX_PROFILE_SECONDS = 120.0
+DEBUG_RSS_INTERVAL = 0.05
+# Innermost frames of threads that are only waiting; left out of profiles by default.
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    (os.path.basename(__file__), "_rss_sampler"),
+}
+_UNTRACKED_PATHS = ("/debug", "/healthz", "/readyz", "/metrics")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+_REQUEST_RECORD: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("rag_request_record", default=None)
+_INFLIGHT_REQUESTS: dict[int, dict] = {}
+_RECENT_REQUESTS: deque[dict] = deque(maxlen=200)
+_REQUEST_IDS = itertools.count(1)
+_TRACEMALLOC_BASELINE: Optional[tracemalloc.Snapshot] = None
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * _PAGE_SIZE
+
+
+def _rss_sampler() -> None:
+    """Raise the peak RSS of every in-flight request to the current RSS."""
+    while True:
+        rss = _rss_bytes()
+        for record in list(_INFLIGHT_REQUESTS.values()):
+            if rss > record["rss_peak"]:
+                record["rss_peak"] = rss
+        time.sleep(DEBUG_RSS_INTERVAL)
+
+
+def _request_view(record: dict, now: float) -> Dict[str, Any]:
+    deadline = record.get("deadline")
+    return {
+        "pid": os.getpid(),
+        "id": record["id"],
+        "method": record["method"],
+        "path": record["path"],
+        "stage": deadline.stage if deadline is not None else "",
+        "elapsed_seconds": round(record.get("elapsed", now - record["started"]), 3),
+        "status": record.get("status"),
+        "rss_start_mb": round(record["rss_start"] / 2**20, 1),
+        "rss_peak_mb": round(record["rss_peak"] / 2**20, 1),
+        "rss_growth_mb": round((record["rss_peak"] - record["rss_start"]) / 2**20, 1),
+    }
+
+
+def _local_requests() -> Dict[str, list]:
+    now = time.monotonic()
+    return {
+        "inflight": [_request_view(r, now) for r in list(_INFLIGHT_REQUESTS.values())],
+        "recent": [_request_view(r, now) for r in list(_RECENT_REQUESTS)],
+    }
+
+
+class _RequestTracker:
+    """Pure ASGI middleware recording in-flight requests. Unlike
+    BaseHTTPMiddleware it hands `receive` to the app untouched, so
+    request.is_disconnected() still sees the client leave."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(_UNTRACKED_PATHS):
+            await self.app(scope, receive, send)
+            return
+        rss = _rss_bytes()
+        record = {
+            "id": next(_REQUEST_IDS),
+            "method": scope["method"],
+            "path": scope["path"],
+            "started": time.monotonic(),
+            "rss_start": rss,
+            "rss_peak": rss,
+        }
+        status = 500
+
+        async def send_tracked(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        _INFLIGHT_REQUESTS[record["id"]] = record
+        token = _REQUEST_RECORD.set(record)
+        try:
+            await self.app(scope, receive, send_tracked)
+        finally:
+            _REQUEST_RECORD.reset(token)
+            del _INFLIGHT_REQUESTS[record["id"]]
+            record["rss_peak"] = max(record["rss_peak"], _rss_bytes())
+            record.update(status=status, elapsed=time.monotonic() - record["started"])
+            _RECENT_REQUESTS.append(record)
+
+
+def _require_debug_token(request: Request) -> None:
+    supplied = request.headers.get("x-debug-token", "")
+    if not hmac.compare_digest(supplied.encode("utf-8"), DEBUG_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+
+def _sample_stacks(seconds: float, hz: float, include_idle: bool) -> dict[str, int]:
+    """Sample every other thread's stack; returns collapsed stacks
+    ("thread;outer;...;inner") with their sample counts."""
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts: dict[str, int] = {}
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if not include_idle and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(1.0 / hz)
+    return counts
+
+
+def _allocation_stats(stats: list, limit: int) -> list[Dict[str, Any]]:
+    return [
+        {
+            "where": stat.traceback.format()[-1].strip() if stat.traceback else "",
+            "traceback": [line.strip() for line in stat.traceback.format()],
+            "size_kb": round(stat.size / 1024, 1),
+            "size_diff_kb": round(getattr(stat, "size_diff", 0) / 1024, 1),
+            "count": stat.count,
+            "count_diff": getattr(stat, "count_diff", 0),
+        }
+        for stat in stats[:limit]
+    ]
+
+
+def _tracemalloc_snapshot() -> tracemalloc.Snapshot:
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is not running; POST /debug/tracemalloc/start")
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    )
+
+
+debug_router = APIRouter(prefix="/debug", dependencies=[Depends(_require_debug_token)])
+
+
+@debug_router.get("/profile")
+async def debug_profile(seconds: float = 10.0, hz: float = 100.0, idle: bool = False):
+    """CPU profile of this worker process in collapsed-stack format (flamegraph.pl, speedscope)."""
+    seconds = min(max(seconds, 0.1), DEBUG_MAX_PROFILE_SECONDS)
+    hz = min(max(hz, 1.0), 1000.0)
+    counts = await run_in_threadpool(_sample_stacks, seconds, hz, idle)
+    lines = [f"{stack} {n}" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1])]
+    return PlainTextResponse("\n".join(lines) + "\n", headers={"X-Worker-Pid": str(os.getpid())})
+
+
+@debug_router.post("/tracemalloc/start")
+def debug_tracemalloc_start(frames: int = 10):
+    global _TRACEMALLOC_BASELINE
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(min(max(frames, 1), 50))
+    _TRACEMALLOC_BASELINE = None
+    return {"pid": os.getpid(), "tracing": True, "frames": tracemalloc.get_traceback_limit()}
+
+
+@debug_router.post("/tracemalloc/stop")
+def debug_tracemalloc_stop():
+    global _TRACEMALLOC_BASELINE
+    tracemalloc.stop()
+    _TRACEMALLOC_BASELINE = None
+    return {"pid": os.getpid(), "tracing": False}
+
+
+@debug_router.get("/tracemalloc/snapshot")
+def debug_tracemalloc_snapshot(limit: int = 25, group_by: str = "lineno"):
+    """Top allocation sites now; the snapshot becomes the baseline for /diff."""
+    global _TRACEMALLOC_BASELINE
+    snapshot = _tracemalloc_snapshot()
+    _TRACEMALLOC_BASELINE = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "pid": os.getpid(),
+        "traced_mb": round(current / 2**20, 1),
+        "traced_peak_mb": round(peak / 2**20, 1),
+        "top": _allocation_stats(snapshot.statistics(group_by), limit),
+    }
+
+
+@debug_router.get("/tracemalloc/diff")
+def debug_tracemalloc_diff(limit: int = 25, group_by: str = "lineno"):
+    """Allocation growth since the last snapshot or diff, largest first."""
+    global _TRACEMALLOC_BASELINE
+    snapshot = _tracemalloc_snapshot()
+    if _TRACEMALLOC_BASELINE is None:
+        raise HTTPException(status_code=409, detail="No baseline; GET /debug/tracemalloc/snapshot first")
+    stats = snapshot.compare_to(_TRACEMALLOC_BASELINE, group_by)
+    _TRACEMALLOC_BASELINE = snapshot
+    return {"pid": os.getpid(), "top": _allocation_stats(stats, limit)}
+
+
+@debug_router.get("/requests")
+def debug_requests():
+    """In-flight requests with their pipeline stage and elapsed time, plus recently
+    finished ones, across all worker processes of this pod. RSS is per process:
+    peak is the highest process RSS seen while the request ran."""
+    _publish_metrics()
+    inflight, recent = [], []
+    for published in _worker_files("requests"):
+        inflight += published["inflight"]
+        recent += published["recent"]
+    inflight.sort(key=lambda r: -r["elapsed_seconds"])
+    return {"inflight": inflight, "recent": recent}
+
+
+if DEBUG_TOKEN:
+    app.include_router(debug_router)
+    app.add_middleware(_RequestTracker)
@@ -0,0 +1,59 @@
+import time
+
+# ---------------------------
+# Cold start: fast phase (import app) vs warm-up phase (heavy modules)
+# ---------------------------
+start = time.perf_counter()
+import app  # noqa: E402
+
+print(f"import app: {time.perf_counter() - start:.3f}s")
+
+app._warm_up()
+if app._WARM_STATE["error"]:
+    print(f"warm-up failed: {app._WARM_STATE['error']}")
+else:
+    print(f"warm-up: {app._WARM_STATE['seconds']:.3f}s")
+for name, seconds in sorted(app.IMPORT_TIMINGS.items(), key=lambda kv: -kv[1]):
+    print(f"  import {name}: {seconds:.3f}s")
+
+# ---------------------------
+# Splitters: chunks/sec of the character splitter vs the token splitter
+# ---------------------------
+import glob  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+
+pdfs = sys.argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "*.pdf")))
+documents = []
+for path in pdfs:
+    with open(path, "rb") as f:
+        data = f.read()
+    documents.append([p["text"] for p in app._parsed_pages(data, app._sha256_bytes(data))])
+# Repeat small corpora so timings are not dominated by per-call overhead.
+pages_total = sum(len(d) for d in documents)
+documents = documents * max(1, 2000 // max(1, pages_total))
+chars = sum(len(p) for d in documents for p in d)
+limit = app.EMBEDDING_MAX_TOKENS - 2
+count = app._token_counter()
+
+
+def split_document(splitter, pages):
+    # Ingestion splits a document's pages in one batch when the splitter supports it.
+    if isinstance(splitter, app.SentenceTokenSplitter):
+        return [c for page_chunks in splitter.split_texts(pages) for c in page_chunks]
+    return [c for page in pages for c in splitter.split_text(page)]
+
+
+splitters = {
+    "recursive (1000 chars, 200 overlap)": app._import("langchain_text_splitters").RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200
+    ),
+    "token (256 tokens, 48 overlap)": app.SentenceTokenSplitter(256, 48),
+}
+print(f"splitting {sum(len(d) for d in documents)} pages, {chars / 1e6:.1f}M chars")
+for name, splitter in splitters.items():
+    start = time.perf_counter()
+    chunks = [c for pages in documents for c in split_document(splitter, pages)]
+    seconds = time.perf_counter() - start
+    over = sum(1 for n in count(chunks) if n > limit)
+    print(f"  {name}: {len(chunks) / seconds:,.0f} chunks/s, {chars / seconds / 1e6:.1f}M chars/s, {over} over {limit} tokens")
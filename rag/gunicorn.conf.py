@@ -0,0 +1,30 @@
+import math
+import os
+from pathlib import Path
+
+
+def _cpu_limit() -> int:
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    # cgroup v1
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("RAG_WORKERS") or 0) or _cpu_limit()
+# Generations can legitimately take minutes; let the request deadline decide.
+timeout = int(os.getenv("RAG_WORKER_TIMEOUT", "300"))
+graceful_timeout = 30
@@ -1,6 +1,7 @@
 import express from "express";
 import cors from "cors";
 import multer from "multer";
+import crypto from "crypto";
 import { promises as fs } from "fs";
 import path from "path";
 
@@ -10,6 +11,18 @@ app.use(express.json());
 const upload = multer({ storage: multer.memoryStorage() });
 const CONFIG_PATH = process.env.CONFIG_PATH || "/data/quiz-config.json";
 
+// Sent as X-Document-Key on every request so Istio's consistent-hash routing
+// sends all requests for a document, the first one included, to the same rag
+// pod. For uploads this is the key the RAG service itself derives (sha256 of
+// the sorted per-PDF sha256s); URL-only requests hash the URL.
+const sha256 = (data) => crypto.createHash("sha256").update(data).digest("hex");
+
+const documentKey = (pdfUrl, files) => {
+  if (!files.length) return pdfUrl ? sha256(`url\0${pdfUrl}`).slice(0, 32) : "";
+  const hashes = files.map((file) => sha256(file.buffer)).sort();
+  return sha256(hashes.join("\0")).slice(0, 32);
+};
+
 const ensureConfigDir = async () => {
   const dir = path.dirname(CONFIG_PATH);
   await fs.mkdir(dir, { recursive: true });
@@ -62,6 +75,7 @@ app.post("/api/generate", upload.array("files"), async (req, res) => {
     chunkSize,
     chunkOverlap,
     topK,
+    profile,
   } = req.body;
 
   try {
@@ -101,18 +115,47 @@ app.post("/api/generate", upload.array("files"), async (req, res) => {
         chunk_size: toNumber(chunkSize),
         chunk_overlap: toNumber(chunkOverlap),
         top_k: toNumber(topK),
+        profile: profile || undefined,
       },
     };
 
-    const response = await fetch(ragUrl, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(body),
+    // Give the RAG service our remaining budget and stop it when the client leaves.
+    const timeoutMs = Number(process.env.RAG_REQUEST_TIMEOUT || 290) * 1000;
+    const controller = new AbortController();
+    const timer = setTimeout(() => controller.abort(), timeoutMs);
+    res.on("close", () => {
+      if (!res.writableEnded) controller.abort();
     });
 
+    const headers = {
+      "Content-Type": "application/json",
+      "X-Request-Timeout": String(timeoutMs / 1000),
+    };
+    const key = documentKey(body.rag.pdf_url, files);
+    if (key) headers["X-Document-Key"] = key;
+
+    let response;
+    try {
+      response = await fetch(ragUrl, {
+        method: "POST",
+        headers,
+        body: JSON.stringify(body),
+        signal: controller.signal,
+      });
+    } catch (err) {
+      if (err.name === "AbortError") {
+        return res.headersSent ? undefined : res.status(504).json({ error: "RAG request timed out" });
+      }
+      throw err;
+    } finally {
+      clearTimeout(timer);
+    }
+
     if (!response.ok) {
       const text = await response.text();
       console.error("RAG error:", response.status, text);
+      const retryAfter = response.headers.get("retry-after");
+      if (retryAfter) res.set("Retry-After", retryAfter);
       return res.status(response.status).json({ error: text });
     }
 